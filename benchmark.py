@@ -0,0 +1,477 @@
+import argparse
+import contextlib
+import email.utils
+import http.server
+import itertools
+import json
+import os
+import pickle
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import main
+
+# synthetic data sets
+class SyntheticData:
+    _cities = ['London', 'Frankfurt', 'Ashburn', 'Singapore', 'Sydney', 'Tokyo', 'Dublin', 'Toronto']
+    _regions = ['England', 'Hesse', 'Virginia', 'Singapore', 'New South Wales', 'Tokyo', 'Leinster', 'Ontario']
+    _countries = ['GB', 'DE', 'US', 'SG', 'AU', 'JP', 'IE', 'CA']
+    _states = ['ESTABLISHED', 'TIME_WAIT', 'CLOSE_WAIT', 'SYN_SENT']
+
+    # returns n distinct public ipv4 addresses
+    @staticmethod
+    def remote_ips(n, seed = 1):
+        r = random.Random(seed)
+        ips = set()
+        while len(ips) < n:
+            ip = socket.inet_ntoa(r.getrandbits(32).to_bytes(4, 'big'))
+            if not main.NetworkUtils.is_internal(ip):
+                ips.add(ip)
+        return sorted(ips)
+
+    # returns a list of (local ip, local port, remote ip, remote port, state)
+    # tuples spread across the given remote addresses
+    @staticmethod
+    def connections(n, remote_ips, seed = 1):
+        r = random.Random(seed)
+        return [('10.0.0.2', 1024 + (i % 64000), r.choice(remote_ips), r.choice((80, 443, 8443)), r.choice(SyntheticData._states)) for i in range(n)]
+
+    # returns the (hostname, city, region, country, location) fields of ip
+    @staticmethod
+    def info(ip):
+        idx = hash(ip) % len(SyntheticData._cities)
+        return ('host-' + ip.replace('.', '-') + '.example.net', SyntheticData._cities[idx], SyntheticData._regions[idx], SyntheticData._countries[idx], '51.5,-0.1')
+
+# mock geolocation server - answers the ipinfo.io single and batch endpoints
+# and the ip-api.com endpoint with synthetic records after a fixed latency
+#
+# responses - the (status, headers) of the next responses, each request takes
+# the first and the remaining requests are answered with 200, an error status
+# is sent with an error body
+# requests - the (method, path) of each request received
+class MockGeolocationServer:
+    def __init__(self, latency = 0.0):
+        self.responses = []
+        self.requests = []
+        lock = threading.Lock()
+        def next_response(method, path):
+            with lock:
+                self.requests.append((method, path.split('?')[0]))
+                return self.responses.pop(0) if self.responses else (200, {})
+        def record(ip):
+            hostname, city, region, country, loc = SyntheticData.info(ip)
+            return {'ip': ip, 'hostname': hostname, 'city': city, 'region': region, 'country': country, 'loc': loc, 'org': 'AS64500 Example'}
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def _send(self, body):
+                status, headers = next_response(self.command, self.path)
+                if status != 200:
+                    body = {'error': {'status': status}}
+                data = json.dumps(body).encode('utf-8')
+                time.sleep(latency)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            def do_GET(self):
+                parts = self.path.split('?')[0].strip('/').split('/')
+                if parts[0] == 'json':
+                    r = record(parts[1])
+                    lat, lon = r['loc'].split(',')
+                    self._send({'query': r['ip'], 'country': r['country'], 'regionName': r['region'], 'city': r['city'], 'lat': float(lat), 'lon': float(lon), 'isp': r['hostname'], 'as': r['org']})
+                else:
+                    self._send(record(parts[0]))
+            def do_POST(self):
+                ips = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                self._send({ip: record(ip) for ip in ips})
+            def log_message(self, *args):
+                pass
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d' % self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+# the per-instance __dict__ layout of the records before they were slotted,
+# kept here as the baseline of the memory benchmark
+class _DictSocketConnection:
+    def __init__(self, local_ip, local_port, remote_ip, remote_port, conn_type, status):
+        self.local_ip = local_ip
+        self.local_port = int(local_port)
+        self.remote_ip = remote_ip
+        self.remote_port = int(remote_port)
+        self.conn_type = conn_type
+        self.conn_status = status
+        self.log_time = time.time()
+
+class _DictAddressInfo:
+    def __init__(self, ip_addr, hostname, city, region, country, location):
+        self._ip_addr = ip_addr
+        self._hostname = hostname
+        self._city = city
+        self._region = region
+        self._country = country
+        self._location = location
+        self._log_time = time.time()
+
+# returns the bytes retained per object created by factory, each row is given
+# fresh copies of its strings as they arrive from psutil and the suppliers
+def _allocated(factory, rows):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [factory(*_copy(row)) for row in rows]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return (after - before) / len(rows)
+
+def _copy(row):
+    return tuple((v + '.')[:-1] if type(v) is str else v for v in row)
+
+def bench_memory(args):
+    remote_ips = SyntheticData.remote_ips(max(1, args.n // 20))
+    conns = [c + (socket.SOCK_STREAM,) for c in SyntheticData.connections(args.n, remote_ips)]
+    infos = [(ip,) + SyntheticData.info(ip) for ip in remote_ips]
+
+    print(f'{args.n} connections to {len(remote_ips)} remote addresses')
+    print('%-20s before %8.1f  after %8.1f' % ('connection bytes',
+        _allocated(lambda l, lp, r, rp, st, t: _DictSocketConnection(l, lp, r, rp, t, st), conns),
+        _allocated(lambda l, lp, r, rp, st, t: main.SocketConnection(l, lp, r, rp, t, st), conns)))
+    print('%-20s before %8.1f  after %8.1f' % ('cache entry bytes',
+        _allocated(_DictAddressInfo, infos),
+        _allocated(main.IP_AddressInfo, infos)))
+
+    # serialized - the pickled cache of earlier releases against the slotted
+    # records and the sqlite store
+    legacy = {ip: _DictAddressInfo(*row) for ip, row in zip(remote_ips, infos)}
+    slotted = {row[0]: main.IP_AddressInfo(*row) for row in infos}
+    print('%-20s before %8.1f  after %8.1f' % ('cache pickle bytes', len(pickle.dumps(legacy)) / len(infos), len(pickle.dumps(slotted)) / len(infos)))
+    with tempfile.TemporaryDirectory() as d:
+        store = main.CacheStore(os.path.join(d, 'info_cache.db'), legacy_path=None)
+        for row in infos:
+            store.put(row[0], main.IP_AddressInfo(*row))
+        store.close()
+        on_disk = sum(os.path.getsize(os.path.join(d, f)) for f in os.listdir(d))
+    print('%-20s %30.1f' % ('cache sqlite bytes', on_disk / len(infos)))
+
+# synthetic /proc fixtures - the socket tables of a busy host and the fd
+# tables of the processes holding the sockets
+class ProcFixture:
+    _head = '  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n'
+    _line = '%4d: %s:%04X %s:%04X %s 00000000:00000000 00:00000000 00000000  1000        0 %d 1 0000000000000000 20 4 30 10 -1\n'
+
+    # the address as the kernel prints it, each 32 bit word in host byte order
+    @staticmethod
+    def _address(ip):
+        packed = socket.inet_pton(socket.AF_INET6 if ':' in ip else socket.AF_INET, ip)
+        return ''.join('%08X' % int.from_bytes(packed[i:i + 4], sys.byteorder) for i in range(0, len(packed), 4))
+
+    # write n sockets under root, one in every listen_every is a listener or
+    # an unconnected udp socket, the sockets are shared out between procs
+    # processes
+    @staticmethod
+    def write(root, n, procs = 100, listen_every = 4, seed = 1):
+        r = random.Random(seed)
+        conns = SyntheticData.connections(n, SyntheticData.remote_ips(max(1, n // 20), seed), seed)
+        tables = {'tcp': [], 'tcp6': [], 'udp': [], 'udp6': []}
+        for i, (lip, lport, rip, rport, state) in enumerate(conns):
+            name = r.choice(('tcp', 'tcp', 'tcp', 'tcp6', 'udp', 'udp6'))
+            if name.endswith('6'):
+                lip, rip = '::ffff:' + lip, '::ffff:' + rip
+            if name.startswith('udp'):
+                state = 'NONE'
+            if i % listen_every == 0:
+                rip, rport, state = ('::' if name.endswith('6') else '0.0.0.0'), 0, 'LISTEN' if name.startswith('tcp') else 'NONE'
+            code = {'ESTABLISHED': '01', 'SYN_SENT': '02', 'TIME_WAIT': '06', 'CLOSE_WAIT': '08', 'LISTEN': '0A', 'NONE': '07'}[state]
+            tables[name].append((ProcFixture._address(lip), lport, ProcFixture._address(rip), rport, code, 100000 + i))
+        os.makedirs(os.path.join(root, 'net'))
+        for name, rows in tables.items():
+            with open(os.path.join(root, 'net', name), 'w') as f:
+                f.write(ProcFixture._head)
+                for sl, row in enumerate(rows):
+                    f.write(ProcFixture._line % ((sl,) + row))
+        for pid in range(1000, 1000 + procs):
+            os.makedirs(os.path.join(root, str(pid), 'fd'))
+        for i in range(n):
+            os.symlink('socket:[%d]' % (100000 + i), os.path.join(root, str(1000 + i % procs), 'fd', str(3 + i // procs)))
+
+def _timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best == None else min(best, elapsed)
+    return best, result
+
+def _sweep_key(c):
+    return (c.type, c.laddr.ip, c.laddr.port, c.raddr.ip, c.raddr.port, c.status, c.pid)
+
+def bench_proc(args):
+    root = tempfile.mkdtemp()
+    procfs_path = main.psutil.PROCFS_PATH
+    try:
+        ProcFixture.write(os.path.join(root, 'proc'), args.n, args.procs)
+        main.psutil.PROCFS_PATH = os.path.join(root, 'proc')
+        print(f'{args.n} sockets held by {args.procs} processes, best of {args.repeat}')
+
+        # psutil returns every socket, the sweep keeps those with a remote
+        # address - the collector only yields those
+        for pids in (True, False):
+            collector = main.ProcNetCollector(os.path.join(root, 'proc'), pids)
+            before, expected = _timed(lambda: [c for c in main.psutil.net_connections() if c.raddr], args.repeat)
+            after, live = _timed(lambda: list(collector()), args.repeat)
+            if not pids:
+                expected = [c._replace(fd=-1, pid=None) for c in expected]
+            same = sorted(map(_sweep_key, expected)) == sorted(map(_sweep_key, live))
+            print('%-20s before %8.1fms  after %8.1fms  %s' % ('sweep with pids' if pids else 'sweep', before * 1000, after * 1000, 'matching' if same else 'MISMATCH'))
+    finally:
+        main.psutil.PROCFS_PATH = procfs_path
+        shutil.rmtree(root)
+
+# the report of n connections as a single table against the summarized report
+# with the connections capped, both timed on a first render and a re-render
+def bench_report(args):
+    remote_ips = SyntheticData.remote_ips(max(1, args.n // 20))
+    now = time.time()
+    cl = {}
+    for i, (lip, lport, rip, rport, state) in enumerate(SyntheticData.connections(args.n, remote_ips)):
+        cl[i] = main.SocketConnection(lip, lport, rip, rport, socket.SOCK_STREAM, state, None, now)
+    il = {ip: main.IP_AddressInfo(ip, *SyntheticData.info(ip)) for ip in remote_ips}
+    cwd = os.getcwd()
+    root = tempfile.mkdtemp()
+    try:
+        os.chdir(root)
+        print(f'{args.n} connections to {len(remote_ips)} remote addresses')
+        for title, limit in (('full table', 0), ('summarized', args.rl)):
+            main.ReportWriter.discard(list(cl))
+            first, _ = _timed(lambda: main.ReportWriter.write(cl, il, row_limit=limit), 1)
+            again, _ = _timed(lambda: main.ReportWriter.write(cl, il, row_limit=limit), args.repeat)
+            size = os.path.getsize('nlabs.studio_report.htm')
+            data = os.path.getsize('nlabs.studio_report.js') if os.path.isfile('nlabs.studio_report.js') else 0
+            print('%-20s first %8.1fms  again %8.1fms  report %8.1fKB  data %8.1fKB' % (title, first * 1000, again * 1000, size / 1024, data / 1024))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root)
+
+# days of history of n live connections sampled cycles times a day with a
+# tenth of the connections replaced each cycle, against the -mr reports of
+# the same cycles
+def bench_history(args):
+    r = random.Random(1)
+    remote_ips = SyntheticData.remote_ips(max(1, args.n // 5))
+    il = {ip: main.IP_AddressInfo(ip, *SyntheticData.info(ip)) for ip in remote_ips}
+    cwd = os.getcwd()
+    root = tempfile.mkdtemp()
+    try:
+        os.chdir(root)
+        history = main.HistoryStore(os.path.join(root, 'history'), retention_days=args.days + 1)
+        start = time.time() - args.days * 86400
+        live = {}
+        serial = 0
+        for cycle in range(args.days * args.cycles):
+            now = start + cycle * 86400 / args.cycles
+            closed = [live.pop(key) for key in r.sample(list(live), len(live) // 10)]
+            for c in live.values():
+                c.last_seen = now
+            added = []
+            while len(live) < args.n:
+                serial += 1
+                c = main.SocketConnection('10.0.0.2', 1024 + serial % 64000, r.choice(remote_ips), r.choice((80, 443, 8443)), socket.SOCK_STREAM, r.choice(SyntheticData._states), None, now)
+                live[serial] = c
+                added.append(c)
+            carried = list(live.values()) if history.starts_segment(now) else []
+            history.append(now, added, [il[c.remoteIP()] for c in itertools.chain(added, closed, carried)], closed, carried)
+        history.maintain(now)
+        history_bytes = sum(os.path.getsize(path) for _, path in history.segments())
+
+        # each -mr report is a standalone document
+        main.ReportWriter.write(live, il, mr=True)
+        report_bytes = sum(os.path.getsize(f) for f in os.listdir(root) if os.path.isfile(f)) * args.days * args.cycles
+
+        print(f'{args.days} days of {args.n} connections sampled {args.cycles} times a day, {serial} connections recorded')
+        print('%-20s -mr %10.1fMB  history %8.1fMB' % ('disk use', report_bytes / 1048576, history_bytes / 1048576))
+        target = history.first_seen(remote_ips[-1])[1]['hostname']
+        for title, fn in (
+            ('count last 24h', lambda: history.count(24, 'country', now)),
+            ('count all days', lambda: history.count(args.days * 24, 'country', now)),
+            ('count new last 24h', lambda: history.count_new(24, 'country', now)),
+            ('count new all days', lambda: history.count_new(args.days * 24, 'country', now)),
+            ('first seen', lambda: history.first_seen(target))):
+            elapsed, _ = _timed(fn, args.repeat)
+            print('%-20s %26.1fms' % (title, elapsed * 1000))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root)
+
+# the psutil style connections of a synthetic connection set
+def _live(rows, serial = 0):
+    return [main.ProcConnection(-1, socket.AF_INET, socket.SOCK_STREAM, main.ProcAddress(lip, lport + serial), main.ProcAddress(rip, rport), state, None)
+        for lip, lport, rip, rport, state in rows]
+
+# replays synthetic connection sets through the sweep, resolve, persist and
+# report stages against the mock geolocation server, a cold cycle with every
+# remote address to resolve and a warm cycle with a tenth of the connections
+# replaced
+def bench_pipeline(args):
+    server = MockGeolocationServer(args.latency / 1000.0)
+    cwd = os.getcwd()
+    stages = ('collect', 'sweep', 'resolve', 'persist', 'report')
+    print('%9s %6s' % ('sockets', 'cycle') + ''.join('%10s' % s for s in stages) + '%10s%10s%8s%8s' % ('lookup50', 'lookup99', 'hits', 'misses'))
+    try:
+        for n in args.sizes:
+            root = tempfile.mkdtemp()
+            os.chdir(root)
+            main.Metrics.reset()
+            main.ReportWriter._rows.clear()
+            rows = SyntheticData.connections(n, SyntheticData.remote_ips(max(1, n // 20)))
+            client = main.GeolocationClient('benchmark', ipinfo_rate=0, ipapi_rate=0, ipinfo_url=server.url, ipapi_url=server.url, pool_size=args.w)
+            pipeline = main.SnapshotPipeline(main.CacheStore(os.path.join(root, 'info_cache.db'), legacy_path=None), main.AddressResolver(client, args.w),
+                main.NegativeCache(), collector=lambda: live)
+            try:
+                live = _live(rows)
+                counters = {}
+                for cycle in ('cold', 'warm'):
+                    if cycle == 'warm':
+                        cut = len(live) // 10
+                        live = live[cut:] + _live(rows[:cut], 1)
+
+                    # the console noise of the resolver is left out
+                    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                        added, removed, _ = pipeline.sweep()
+                        pipeline.resolve(added)
+                        pipeline.persist()
+                        pipeline.report(removed=removed)
+                    snapshot = main.Metrics.snapshot()
+                    timings = snapshot['timings']
+                    lookups = timings.get('supplier_request{supplier="%s"}' % server.url.partition('://')[2], {})
+                    hits, misses = (snapshot['counters'].get(k, 0) - counters.get(k, 0) for k in ('cache_hits', 'cache_misses'))
+                    counters = snapshot['counters']
+                    print('%9d %6s' % (n, cycle) + ''.join('%8.1fms' % (timings[s]['last'] * 1000) for s in stages) +
+                        '%8.1fms%8.1fms%8d%8d' % (lookups.get('p50', 0) * 1000, lookups.get('p99', 0) * 1000, hits, misses))
+            finally:
+                pipeline.close()
+                os.chdir(cwd)
+                shutil.rmtree(root)
+    finally:
+        server.close()
+
+# the retry and throttling paths of the supplier client against scripted mock
+# server responses, each check prints ok or FAILED and a failure sets the exit
+# status
+def bench_suppliers(args):
+    server = MockGeolocationServer()
+    ip = '203.0.113.7'
+    def scripted(*responses):
+        server.responses[:] = responses
+        server.requests[:] = []
+    def timed(fn):
+        started = time.monotonic()
+        result = fn()
+        return result, time.monotonic() - started
+
+    # each check returns the (passed, detail) of the scenario
+    def retry_after():
+        scripted((429, {'Retry-After': '1'}))
+        data, elapsed = timed(lambda: main.SupplierClient(server.url, 0).request('GET', f'/{ip}/json'))
+        return data != None and len(server.requests) == 2 and elapsed >= 1, f'{len(server.requests)} requests in {elapsed:.1f}s'
+    def retry_after_date():
+        scripted((429, {'Retry-After': email.utils.formatdate(time.time() + 3, usegmt=True)}))
+        data, elapsed = timed(lambda: main.SupplierClient(server.url, 0).request('GET', f'/{ip}/json'))
+        return data != None and len(server.requests) == 2 and elapsed >= 1.5, f'{len(server.requests)} requests in {elapsed:.1f}s'
+    def retry_after_too_long():
+        scripted((429, {'Retry-After': str(main.g_rate_limit_wait + 60)}))
+        client = main.SupplierClient(server.url, 600)
+        first, elapsed = timed(lambda: client.request('GET', f'/{ip}/json'))
+        second = client.request('GET', f'/{ip}/json')
+        return first == None and second == None and len(server.requests) == 1 and elapsed < 1, f'{len(server.requests)} requests over two calls'
+    def server_error():
+        scripted((503, {}))
+        data, elapsed = timed(lambda: main.SupplierClient(server.url, 0).request('GET', f'/{ip}/json'))
+        return data != None and len(server.requests) == 2, f'{len(server.requests)} requests in {elapsed:.1f}s'
+    def retries_exhausted():
+        scripted((500, {}), (502, {}), (503, {}))
+        data, elapsed = timed(lambda: main.SupplierClient(server.url, 0, retries=1).request('GET', f'/{ip}/json'))
+        return data == None and len(server.requests) == 2, f'{len(server.requests)} requests in {elapsed:.1f}s'
+    def ipapi_pause():
+        scripted((200, {'X-Rl': '0', 'X-Ttl': '1'}))
+        client = main.SupplierClient(server.url, 600)
+        first = client.request('GET', f'/json/{ip}')
+        second, elapsed = timed(lambda: client.request('GET', f'/json/{ip}'))
+        return first != None and second != None and elapsed >= 0.9, f'the next request waited {elapsed:.1f}s'
+    def batch_fallback():
+        ips = SyntheticData.remote_ips(4)
+        scripted(*[(429, {'Retry-After': '0'})] * (main.g_request_retries + 1))
+        client = main.GeolocationClient('mock', is_commerial=False, ipinfo_rate=0, ipapi_rate=0, ipinfo_url=server.url, ipapi_url=server.url)
+        resolver = main.AddressResolver(client, 2)
+        try:
+            results = resolver.resolve(ips)
+        finally:
+            resolver.shutdown()
+        resolved = [ip for ip, (data, _) in results.items() if data != None]
+        fallbacks = sum(1 for method, path in server.requests if path.startswith('/json/'))
+        return len(resolved) == len(ips) and fallbacks == len(ips), f'{len(resolved)} of {len(ips)} resolved by {fallbacks} ip-api.com requests'
+
+    failed = 0
+    try:
+        for title, check in (
+            ('429 Retry-After', retry_after),
+            ('429 Retry-After date', retry_after_date),
+            ('429 beyond the wait', retry_after_too_long),
+            ('5xx retried', server_error),
+            ('5xx exhausted', retries_exhausted),
+            ('ip-api X-Rl pause', ipapi_pause),
+            ('batch fall back', batch_fallback)):
+            passed, detail = check()
+            failed += not passed
+            print('%-24s %-6s %s' % (title, 'ok' if passed else 'FAILED', detail))
+    finally:
+        server.close()
+    if failed:
+        sys.exit(1)
+
+def main_():
+    parser = argparse.ArgumentParser(description="NLabs.Studio Netmonitor Snapshot - benchmarks")
+    commands = parser.add_subparsers(dest='command', required=True)
+    memory = commands.add_parser('memory', help='bytes per connection and per cache entry')
+    memory.add_argument('-n', type=int, default=100000, help='the number of synthetic connections')
+    memory.set_defaults(run=bench_memory)
+    proc = commands.add_parser('proc', help='/proc/net collector against psutil.net_connections()')
+    proc.add_argument('-n', type=int, default=100000, help='the number of synthetic sockets')
+    proc.add_argument('-procs', type=int, default=100, help='the number of synthetic processes holding the sockets')
+    proc.add_argument('-repeat', type=int, default=3, help='the number of timed runs')
+    proc.set_defaults(run=bench_proc)
+    report = commands.add_parser('report', help='report render time and size')
+    report.add_argument('-n', type=int, default=100000, help='the number of synthetic connections')
+    report.add_argument('-rl', type=int, default=main.g_report_rows, help='the number of connections listed in the summarized report')
+    report.add_argument('-repeat', type=int, default=3, help='the number of timed runs')
+    report.set_defaults(run=bench_report)
+    history = commands.add_parser('history', help='connection history disk use and query time')
+    history.add_argument('-n', type=int, default=1000, help='the number of live synthetic connections')
+    history.add_argument('-days', type=int, default=28, help='the number of days recorded')
+    history.add_argument('-cycles', type=int, default=144, help='the number of sweeps a day')
+    history.add_argument('-repeat', type=int, default=3, help='the number of timed runs')
+    history.set_defaults(run=bench_history)
+    pipeline = commands.add_parser('pipeline', help='per stage timings of synthetic connection sets against a mock geolocation server')
+    pipeline.add_argument('-sizes', type=lambda v: [int(n) for n in v.split(',')], default=[1000, 10000, 50000, 200000], help='comma separated numbers of synthetic sockets')
+    pipeline.add_argument('-w', type=int, default=main.g_resolver_workers, help='the number of concurrent lookups')
+    pipeline.add_argument('-latency', type=float, default=20, help='the latency of the mock geolocation server in milliseconds')
+    pipeline.set_defaults(run=bench_pipeline)
+    suppliers = commands.add_parser('suppliers', help='supplier retries, Retry-After and throttling against scripted mock geolocation server responses')
+    suppliers.set_defaults(run=bench_suppliers)
+    args = parser.parse_args()
+    args.run(args)
+
+if __name__ == "__main__":
+    main_()
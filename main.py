@@ -1,14 +1,48 @@
 import argparse
+import array
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import csv
+import email.utils
+import functools
+import html
+import http.server
+import io
+import itertools
 import ipaddress
-import keyboard
+import json
+import mmap
 import pickle
 import psutil
+import random
 import requests
+import requests.adapters
+import signal
 import socket
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
 import time
 import os
+import zlib
 from datetime import datetime
 
+try:
+    import keyboard
+except ImportError:
+    keyboard = None
+
+try:
+    import maxminddb
+except ImportError:
+    maxminddb = None
+
 # the number of days before a requery is necessary to update cache entries
 g_requery_in_days = 3
 
@@ -18,65 +52,945 @@ g_quit_flag = False
 # the default refresh interval between cycles (using seconds)
 g_refresh_interval = 10
 
+# the default number of concurrent lookups performed by the resolver stage
+g_resolver_workers = 8
+
+# the default timeout for each third party or reverse dns request (using seconds)
+g_request_timeout = 5
+
+# the number of retries of a throttled or failed supplier request and the base
+# of their exponential back off (using seconds)
+g_request_retries = 3
+g_retry_backoff = 0.5
+
+# the longest a request waits on the rate limiter or a supplier's Retry-After
+# before giving up (using seconds)
+g_rate_limit_wait = 60
+
+# the number of requests per minute allowed to each supplier, ip-api.com's
+# free tier allows 45 per minute
+g_ipinfo_rate = 600
+g_ipapi_rate = 45
+
+# the number of addresses resolved by each ipinfo.io batch request
+g_ipinfo_batch_size = 100
+
+# the number of seconds before a failed or rate limited lookup is retried
+g_negative_ttl = 300
+
+# the interval between checking every live remote address for cache records
+# due a requery (using seconds)
+g_requery_scan_interval = 3600
+
+# the maximum number of records held in the cache before the least recently
+# used records are evicted
+g_cache_max_entries = 100000
+
+# the maximum number of reverse dns lookups in progress, including those
+# abandoned on an unresponsive resolver
+g_dns_threads = 64
+
+# the number of sweep deltas buffered between the daemon stages
+g_queue_size = 2
+
+# the number of recent ip address classifications memoized
+g_classifier_memo_size = 65536
+
+# the number of connections listed in the report, the full list is written to
+# a data file loaded on demand - 0 lists every connection in the report
+g_report_rows = 1000
+
+# the number of rows of each report summary table
+g_summary_rows = 10
+
+# the number of days of connection history kept before a day is deleted
+g_history_days = 30
+
+# the process umask, the mode of newly created files
+_umask = os.umask(0)
+os.umask(_umask)
+
+# write data to a temporary file alongside path and swap it into place so a
+# reader never sees a partial file, returns the number of bytes written
+#
+# data is bytes or an iterable of bytes, the file keeps the mode of the file
+# it replaces or is given the mode open() would have created it with
+def _write_atomic(path, data):
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = 0o666 & ~_umask
+    fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+    written = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in ((data,) if isinstance(data, bytes) else data):
+                f.write(chunk)
+                written += len(chunk)
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return written
+
+# ip address classifier - decides whether a remote address is internal using
+# integer range tables compiled once at startup
+class IPClassifier:
+
+    # the reserved address space treated as internal - private (RFC1918),
+    # loopback, link-local, carrier grade NAT, documentation and the other
+    # special purpose ranges
+    _internal_networks = [
+        '0.0.0.0/8', '10.0.0.0/8', '100.64.0.0/10', '127.0.0.0/8', '169.254.0.0/16', '172.16.0.0/12',
+        '192.0.0.0/29', '192.0.0.170/31', '192.0.2.0/24', '192.168.0.0/16', '198.18.0.0/15',
+        '198.51.100.0/24', '203.0.113.0/24', '240.0.0.0/4', '255.255.255.255/32',
+        '::/128', '::1/128', '100::/64', '2001::/23', '2001:2::/48', '2001:db8::/32', '2001:10::/28',
+        'fc00::/7', 'fe80::/10']
+
+    # allow - (optional) networks always treated as external
+    # deny - (optional) networks treated as internal, such as our own ranges
+    # memo_size - (optional) the number of recent classifications memoized
+    def __init__(self, allow = (), deny = (), memo_size = g_classifier_memo_size):
+        self._allow = IPClassifier._compile(allow)
+        self._internal = IPClassifier._compile(IPClassifier._internal_networks + list(deny))
+        self.is_internal = functools.lru_cache(maxsize=memo_size)(self._classify)
+
+    # returns a ((v4 starts, v4 ends), (v6 starts, v6 ends)) pair of tables
+    # with any overlapping networks merged
+    @staticmethod
+    def _compile(networks):
+        ranges = ([], [])
+        for n in networks:
+            net = ipaddress.ip_network(n.strip(), strict=False)
+            ranges[net.version == 6].append((int(net.network_address), int(net.broadcast_address)))
+        tables = []
+        for r in ranges:
+            starts = []
+            ends = []
+            for start, end in sorted(r):
+                if ends and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            tables.append((starts, ends))
+        return tables
+
+    @staticmethod
+    def _contains(table, value):
+        idx = bisect.bisect_right(table[0], value) - 1
+        return idx >= 0 and value <= table[1][idx]
+
+    # returns the (is ipv6, integer value) of an address, ipv4-mapped ipv6
+    # addresses are classified as their ipv4 address
+    @staticmethod
+    def _parse(ip):
+        if ':' not in ip:
+            return False, int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+        packed = socket.inet_pton(socket.AF_INET6, ip.partition('%')[0])
+        if packed[:12] == b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xff\xff':
+            return False, int.from_bytes(packed[12:], 'big')
+        return True, int.from_bytes(packed, 'big')
+
+    def _classify(self, ip):
+        try:
+            v6, value = IPClassifier._parse(ip)
+        except (OSError, ValueError):
+            return False
+        if IPClassifier._contains(self._allow[v6], value):
+            return False
+        return IPClassifier._contains(self._internal[v6], value)
+
+    # batch classification of a psutil.net_connections() result, returns the
+    # connections with an external remote address
+    def external_connections(self, conns):
+        is_internal = self.is_internal
+        return [c for c in conns if c.raddr and not is_internal(c.raddr.ip)]
+
+    # parse a comma separated list of networks, or the path of a file listing
+    # one network per line
+    @staticmethod
+    def networks(value):
+        if not value:
+            return []
+        if os.path.isfile(value):
+            with open(value, 'r') as f:
+                lines = [line.partition('#')[0].strip() for line in f]
+        else:
+            lines = [n.strip() for n in value.split(',')]
+        networks = [n for n in lines if n]
+        for n in networks:
+            ipaddress.ip_network(n, strict=False)
+        return networks
+
 # network utilities
 class NetworkUtils:
-    @staticmethod
-    def get_geolocation(ip, token = '', is_commerial = True):
-        headers = {'User-Agent': 'NLabs.Studio Netmonitor Snapshot'}
-        try:            
-            api_url = f"https://ipinfo.io/{ip}/json"
-            if len(token) > 0:
-                api_url = f"https://ipinfo.io/{ip}/json?token={token}"
-            response = requests.get(api_url, headers=headers)
-            data = response.json()
-            if is_commerial:
-                return None
 
-            # fall back option if rate limit has been exceeded 
-            # the end-user has specified a non-commercial use case 
-            # exists
-            if 'error' in data:
-                api_url = f"http://ip-api.com/json/{ip}?fields=country,regionName,city,lat,lon,isp,query"
-                response = requests.get(api_url, headers=headers)
-                data = response.json()
-                if 'lat' in data:
-                    data['loc'] = data['lat']+','+data['lon']
-                    data['ip'] = data['query']
-                    data['region'] = data['regionName']
-                    data['hostname'] = data['isp']
-            return data
-        except:
-            return None
+    # the classifier used by is_internal, replaced at startup when allow or
+    # deny lists are supplied
+    classifier = IPClassifier()
+
+    # gethostbyaddr has no timeout of its own, each lookup runs on a daemon
+    # thread which is abandoned once the timeout has passed, the lookups in
+    # progress are bounded so an unresponsive resolver cannot pile up threads
+    _dns_slots = threading.BoundedSemaphore(g_dns_threads)
+
     @staticmethod
     def is_internal(ip):
+        return NetworkUtils.classifier.is_internal(ip)
+    @staticmethod
+    def reverse_dns(ip, timeout = g_request_timeout):
+        deadline = time.monotonic() + timeout
+        if not NetworkUtils._dns_slots.acquire(timeout=timeout):
+            return None
+        result = []
+        done = threading.Event()
+        def lookup():
+            try:
+                result.append(socket.gethostbyaddr(ip)[0])
+            except OSError:
+                pass
+            finally:
+                NetworkUtils._dns_slots.release()
+                done.set()
+        threading.Thread(target=lookup, name='reverse-dns', daemon=True).start()
+        done.wait(max(0.0, deadline - time.monotonic()))
+        return result[0] if result else None
+
+# pipeline metrics - the counters, gauges and stage timings of each cycle,
+# written to a json file or served in the prometheus text format
+#
+# each metric is keyed by its name and labels, the timings keep a window of
+# recent observations for their percentiles
+class Metrics:
+
+    # the number of recent observations of each timing kept
+    _window = 1024
+    _quantiles = (0.5, 0.9, 0.99)
+
+    _lock = threading.Lock()
+    _counters = {}
+    _gauges = {}
+    _timings = {}
+    _started = time.time()
+
+    @staticmethod
+    def _key(name, labels):
+        if not labels:
+            return name
+        return name + '{' + ','.join(k + '="' + str(v).replace('"', '') + '"' for k, v in sorted(labels.items())) + '}'
+
+    @staticmethod
+    def count(name, n = 1, **labels):
+        key = Metrics._key(name, labels)
+        with Metrics._lock:
+            Metrics._counters[key] = Metrics._counters.get(key, 0) + n
+
+    @staticmethod
+    def gauge(name, value, **labels):
+        key = Metrics._key(name, labels)
+        with Metrics._lock:
+            Metrics._gauges[key] = value
+
+    # record a timing in seconds
+    @staticmethod
+    def observe(name, seconds, **labels):
+        key = Metrics._key(name, labels)
+        with Metrics._lock:
+            timing = Metrics._timings.get(key)
+            if timing == None:
+                timing = Metrics._timings[key] = [0, 0.0, collections.deque(maxlen=Metrics._window)]
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2].append(seconds)
+
+    # context manager timing the block it wraps
+    @staticmethod
+    @contextlib.contextmanager
+    def timer(name, **labels):
+        started = time.perf_counter()
         try:
-            ip_obj = ipaddress.ip_address(ip)
-            if isinstance(ip_obj, ipaddress.IPv4Address):
-                return ip_obj.is_private
-            elif isinstance(ip_obj, ipaddress.IPv6Address):
-                if ip_obj.is_link_local or ip_obj.is_private:
-                    return True
+            yield
+        finally:
+            Metrics.observe(name, time.perf_counter() - started, **labels)
+
+    # returns the last observation of a timing in seconds, or None
+    @staticmethod
+    def last(name, **labels):
+        with Metrics._lock:
+            timing = Metrics._timings.get(Metrics._key(name, labels))
+            return timing[2][-1] if timing != None and timing[2] else None
+
+    # returns the last timings of the named stages in milliseconds for the
+    # console
+    @staticmethod
+    def stages(names):
+        timings = [(name, Metrics.last(name)) for name in names]
+        return ', '.join(name + ' ' + f'{t*1000:.1f}' + 'ms' for name, t in timings if t != None)
+
+    @staticmethod
+    def reset():
+        with Metrics._lock:
+            Metrics._counters.clear()
+            Metrics._gauges.clear()
+            Metrics._timings.clear()
+            Metrics._started = time.time()
+
+    # returns a dictionary of the counters, gauges and timings, each timing
+    # with its count, total, last, max and percentiles over the window
+    @staticmethod
+    def snapshot():
+        with Metrics._lock:
+            timings = {}
+            for key, (n, total, window) in Metrics._timings.items():
+                ordered = sorted(window)
+                timing = {'count': n, 'total': total, 'last': window[-1], 'max': ordered[-1]}
+                for q in Metrics._quantiles:
+                    timing['p' + str(int(q * 100))] = ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+                timings[key] = timing
+            return {'time': time.time(), 'uptime': time.time() - Metrics._started, 'counters': dict(Metrics._counters), 'gauges': dict(Metrics._gauges), 'timings': timings}
+
+    # write the snapshot to a json file
+    @staticmethod
+    def write(path):
+        _write_atomic(path, json.dumps(Metrics.snapshot(), indent=1).encode('utf-8'))
+
+    # returns the snapshot in the prometheus text exposition format, the
+    # timings are exposed as summaries in seconds
+    @staticmethod
+    def prometheus():
+        snapshot = Metrics.snapshot()
+        lines = []
+        typed = set()
+        def sample(key, suffix, kind, value, quantile = None):
+            name, _, labels = key.partition('{')
+            name = 'nlabs_' + name
+            if kind != None and name + suffix not in typed:
+                typed.add(name + suffix)
+                lines.append('# TYPE ' + name + suffix + ' ' + kind)
+            name += suffix if kind != None else '_seconds' + suffix
+            labels = labels[:-1]
+            if quantile != None:
+                labels = (labels + ',' if labels else '') + 'quantile="' + str(quantile) + '"'
+            lines.append(name + ('{' + labels + '}' if labels else '') + ' ' + repr(float(value)))
+        for key, value in sorted(snapshot['counters'].items()):
+            sample(key, '_total', 'counter', value)
+        for key, value in sorted(snapshot['gauges'].items()):
+            sample(key, '', 'gauge', value)
+        for key, timing in sorted(snapshot['timings'].items()):
+            for q in Metrics._quantiles:
+                sample(key, '_seconds', 'summary', timing['p' + str(int(q * 100))], q)
+            sample(key, '_sum', None, timing['total'])
+            sample(key, '_count', None, timing['count'])
+        return '\n'.join(lines) + '\n'
+
+    # serve the prometheus endpoint (/metrics) from a background thread,
+    # returns the server
+    @staticmethod
+    def serve(port, host = '127.0.0.1'):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = Metrics.prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        return server
+
+# token bucket rate limiter shared by the workers querying a supplier
+class TokenBucket:
+    # rate - the number of requests allowed per minute, unlimited when 0
+    # burst - (optional) the number of requests which may be made back to back
+    def __init__(self, rate, burst = None):
+        self._rate = rate / 60.0
+        self._capacity = float(burst if burst else max(1, rate // 60))
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+    # take a token, waiting at most timeout seconds for one to become
+    # available, returns False when the wait would exceed the timeout
+    def acquire(self, timeout = None):
+        if self._rate <= 0:
+            return True
+        deadline = None if timeout == None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                wait = self._paused_until - now
+                if wait <= 0:
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return True
+                    wait = (1 - self._tokens) / self._rate
+            if deadline != None and now + wait > deadline:
                 return False
-        except:
+            time.sleep(wait)
+    # the number of seconds for n requests to pass the limiter from a full
+    # bucket
+    def delay(self, n):
+        if self._rate <= 0:
+            return 0.0
+        return max(0.0, n - self._capacity) / self._rate
+    # hold back every request for the given number of seconds, such as when
+    # the supplier has asked us to retry later
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+# http client for a geolocation supplier, requests share a pooled keep-alive
+# session and are throttled by the supplier's token bucket
+class SupplierClient:
+    # base_url - the scheme and host of the supplier
+    # rate - the number of requests allowed per minute
+    # timeout - (optional) the timeout of each request in seconds
+    # retries - (optional) the number of retries of a throttled or failed request
+    # pool_size - (optional) the number of keep-alive connections
+    def __init__(self, base_url, rate, timeout = g_request_timeout, retries = g_request_retries, pool_size = g_resolver_workers):
+        self.base_url = base_url.rstrip('/')
+        self._name = self.base_url.partition('://')[2]
+        self._bucket = TokenBucket(rate)
+        self._timeout = timeout
+        self._retries = retries
+        self._session = requests.Session()
+        self._session.headers['User-Agent'] = 'NLabs.Studio Netmonitor Snapshot'
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+    # returns the number of seconds the supplier has asked us to wait, from
+    # the Retry-After header or ip-api.com's X-Rl/X-Ttl headers
+    @staticmethod
+    def _retry_after(response):
+        if response == None:
+            return None
+        value = response.headers.get('Retry-After')
+        if value == None and response.headers.get('X-Rl') == '0':
+            value = response.headers.get('X-Ttl')
+        if value == None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+    # the longest a request takes on a slow or failing supplier, each attempt
+    # timing out with the back off between them - the waits on the rate limiter
+    # and on a throttled supplier are accounted for by delay()
+    def duration(self):
+        backoff = sum(g_retry_backoff * (2 ** attempt) * 1.5 for attempt in range(self._retries))
+        return (self._retries + 1) * self._timeout + backoff
+    # the number of seconds for n requests to pass the rate limiter, allowing
+    # for one pause on a throttled supplier
+    def delay(self, n):
+        return self._bucket.delay(n) + g_rate_limit_wait
+    # perform a request, returns the decoded json response or None once the
+    # retries are exhausted
+    def request(self, method, path, **kwargs):
+        for attempt in range(self._retries + 1):
+            if not self._bucket.acquire(g_rate_limit_wait):
+                return None
+            started = time.perf_counter()
+            try:
+                response = self._session.request(method, self.base_url + path, timeout=self._timeout, **kwargs)
+            except requests.RequestException:
+                response = None
+            Metrics.observe('supplier_request', time.perf_counter() - started, supplier=self._name)
+            Metrics.count('supplier_requests', supplier=self._name, status=response.status_code if response != None else 'error')
+
+            # the supplier is throttling us or failed, anything else is final
+            retry_after = SupplierClient._retry_after(response)
+            if response != None and response.status_code != 429 and response.status_code < 500:
+                if retry_after != None:
+                    self._bucket.pause(retry_after)
+                try:
+                    return response.json()
+                except ValueError:
+                    return None
+            if attempt == self._retries:
+                break
+
+            # honour the supplier's wait if it gave one, otherwise back off
+            # exponentially with some jitter
+            if retry_after != None:
+                self._bucket.pause(retry_after)
+                if retry_after > g_rate_limit_wait:
+                    break
+                time.sleep(retry_after)
+            else:
+                time.sleep(g_retry_backoff * (2 ** attempt) * (0.5 + random.random()))
+        return None
+    def close(self):
+        self._session.close()
+
+# offline geolocation database - a local ip range dataset compiled into a
+# sorted binary index which is memory-mapped and searched with bisect
+#
+# the dataset is either a MaxMind database (.mmdb, requires the maxminddb
+# module) or a CSV with a header row naming the start, end, city, region,
+# country, loc and asn columns, the start and end being addresses or integers
+class GeoDatabase:
+
+    # index layout - the header, the ipv4 range starts, ends and record ids as
+    # native u32 arrays, the ipv6 range starts and ends as 16 byte big endian
+    # values followed by their record ids, the record offsets and the blob of
+    # tab separated record fields
+    _magic = b'NLGEOIX1'
+    _header = struct.Struct('=8sIIIII')
+    _byte_order = 0x01020304
+
+    # the CSV column names accepted for each field
+    _columns = {
+        'start': ('start', 'start_ip', 'ip_start', 'range_start', 'network_start'),
+        'end': ('end', 'end_ip', 'ip_end', 'range_end', 'network_end'),
+        'city': ('city', 'city_name'),
+        'region': ('region', 'region_name', 'subdivision', 'state'),
+        'country': ('country', 'country_code', 'country_name'),
+        'loc': ('loc', 'location'),
+        'latitude': ('latitude', 'lat'),
+        'longitude': ('longitude', 'lon', 'lng'),
+        'asn': ('asn', 'as', 'org', 'as_organization')}
+
+    # path - the dataset, its index is kept alongside it as path.idx
+    def __init__(self, path):
+        self._path = path
+        self._reader = None
+        self._records = {}
+        if path.lower().endswith('.mmdb'):
+            if maxminddb == None:
+                raise ValueError('the maxminddb module is required to read '+ path)
+            self._reader = maxminddb.open_database(path, maxminddb.MODE_MMAP)
+            return
+
+        # the index is built once and reused until the dataset changes
+        index_path = path + '.idx'
+        if not os.path.isfile(index_path) or os.path.getmtime(index_path) < os.path.getmtime(path) or not self._open(index_path):
+            GeoDatabase.build(path, index_path)
+            if not self._open(index_path):
+                raise ValueError('the geolocation index could not be opened: '+ index_path)
+    def _open(self, index_path):
+        with open(index_path, 'rb') as f:
+            try:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                return False
+        h = GeoDatabase._header
+        if len(self._mm) < h.size or h.unpack_from(self._mm)[:2] != (GeoDatabase._magic, GeoDatabase._byte_order):
+            self._mm.close()
             return False
+        _, _, n4, n6, nr, _ = h.unpack_from(self._mm)
+        view = memoryview(self._mm)
+        o = h.size
+        self._v4_starts = view[o:o+4*n4].cast('I')
+        o += 4*n4
+        self._v4_ends = view[o:o+4*n4].cast('I')
+        o += 4*n4
+        self._v4_ids = view[o:o+4*n4].cast('I')
+        o += 4*n4
+        self._v6_starts = _PackedInts(view, o, n6)
+        o += 16*n6
+        self._v6_ends = _PackedInts(view, o, n6)
+        o += 16*n6
+        self._v6_ids = view[o:o+4*n6].cast('I')
+        o += 4*n6
+        self._offsets = view[o:o+4*(nr+1)].cast('I')
+        self._blob = o + 4*(nr+1)
+        return True
+    # compile the CSV dataset at path into the index at index_path
     @staticmethod
-    def reverse_dns(ip):
+    def build(path, index_path):
+        v4 = []
+        v6 = []
+        records = {}
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header == None:
+                raise ValueError('the geolocation dataset has no header row: '+ path)
+            header = [c.strip().lower() for c in header]
+            cols = {}
+            for field, names in GeoDatabase._columns.items():
+                for name in names:
+                    if name in header:
+                        cols[field] = header.index(name)
+                        break
+            if 'start' not in cols or 'end' not in cols:
+                raise ValueError('the geolocation dataset needs start and end columns: '+ path)
+            get = lambda row, field: row[cols[field]].strip() if field in cols and cols[field] < len(row) else ''
+
+            # a malformed row is skipped rather than rejecting the dataset,
+            # the line numbers of the first few are reported
+            skipped = []
+            for row in reader:
+                if not row:
+                    continue
+                try:
+                    v6_start, start = GeoDatabase._address(get(row, 'start'))
+                    v6_end, end = GeoDatabase._address(get(row, 'end'))
+                except (OSError, ValueError):
+                    skipped.append(reader.line_num)
+                    continue
+                if v6_start != v6_end or end < start:
+                    skipped.append(reader.line_num)
+                    continue
+                loc = get(row, 'loc')
+                if not loc and get(row, 'latitude'):
+                    loc = get(row, 'latitude') +','+ get(row, 'longitude')
+                asn = get(row, 'asn')
+                if asn.isdigit():
+                    asn = 'AS'+ asn
+                fields = '\t'.join(v.replace('\t', ' ') for v in (get(row, 'city') or '*', get(row, 'region') or '*', get(row, 'country') or '*', loc or '*', asn))
+                rid = records.setdefault(fields, len(records))
+                (v6 if v6_start else v4).append((start, end, rid))
+        if skipped:
+            print('skipped '+ str(len(skipped)) +' malformed rows of '+ path +' at line '+ ', '.join(str(n) for n in skipped[:10]) + (' ...' if len(skipped) > 10 else ''))
+        v4.sort()
+        v6.sort()
+
+        blob = bytearray()
+        offsets = array.array('I', [0])
+        for fields in records:
+            blob += fields.encode('utf-8')
+            offsets.append(len(blob))
+
+        # written alongside and swapped into place so a partial index is never
+        # opened
+        def chunks():
+            yield GeoDatabase._header.pack(GeoDatabase._magic, GeoDatabase._byte_order, len(v4), len(v6), len(records), len(blob))
+            for column in range(3):
+                yield array.array('I', [r[column] for r in v4]).tobytes()
+            for column in range(2):
+                yield b''.join(r[column].to_bytes(16, 'big') for r in v6)
+            yield array.array('I', [r[2] for r in v6]).tobytes()
+            yield offsets.tobytes()
+            yield bytes(blob)
+        _write_atomic(index_path, chunks())
+    # returns the (is ipv6, integer value) of an address or integer string
+    @staticmethod
+    def _address(value):
+        if value.isdigit():
+            n = int(value)
+            return n > 0xFFFFFFFF, n
+        return IPClassifier._parse(value)
+    def _record(self, rid):
+        fields = self._records.get(rid)
+        if fields == None:
+            fields = bytes(self._mm[self._blob + self._offsets[rid]:self._blob + self._offsets[rid+1]]).decode('utf-8').split('\t')
+            self._records[rid] = fields
+        return fields
+    # returns the geolocation data of ip in the form of the ipinfo.io
+    # response, or None when the address is not in the dataset
+    def lookup(self, ip):
+        if self._reader != None:
+            return GeoDatabase._from_mmdb(ip, self._reader.get(ip))
         try:
-            hn, _, _ = socket.gethostbyaddr(ip)
-            return hn
-        except socket.herror:
+            v6, value = IPClassifier._parse(ip)
+        except (OSError, ValueError):
+            return None
+        starts, ends, ids = (self._v6_starts, self._v6_ends, self._v6_ids) if v6 else (self._v4_starts, self._v4_ends, self._v4_ids)
+        idx = bisect.bisect_right(starts, value) - 1
+        if idx < 0 or value > ends[idx]:
             return None
+        city, region, country, loc, asn = self._record(ids[idx])
+        return {'ip': ip, 'city': city, 'region': region, 'country': country, 'loc': loc, 'org': asn}
+    @staticmethod
+    def _from_mmdb(ip, r):
+        if not r:
+            return None
+        name = lambda d: d.get('names', {}).get('en', '*') if d else '*'
+        location = r.get('location', {})
+        data = {'ip': ip, 'city': name(r.get('city')), 'region': name((r.get('subdivisions') or [None])[0]),
+            'country': r.get('country', {}).get('iso_code', '*'), 'loc': '*', 'org': ''}
+        if 'latitude' in location:
+            data['loc'] = f"{location['latitude']},{location['longitude']}"
+        if 'autonomous_system_number' in r:
+            data['org'] = ('AS'+ str(r['autonomous_system_number']) +' '+ r.get('autonomous_system_organization', '')).strip()
+        return data
+    def close(self):
+        if self._reader != None:
+            self._reader.close()
+
+# read-only sequence of the 16 byte big endian integers in a memory-mapped
+# index, for bisect
+class _PackedInts:
+    __slots__ = ('_view', '_offset', '_count')
+    def __init__(self, view, offset, count):
+        self._view = view
+        self._offset = offset
+        self._count = count
+    def __len__(self):
+        return self._count
+    def __getitem__(self, idx):
+        o = self._offset + 16 * idx
+        return int.from_bytes(self._view[o:o+16], 'big')
+
+# geolocation client - ipinfo.io with ip-api.com as the non-commercial fall
+# back option, or a local GeoDatabase with the suppliers as an optional fall
+# back
+class GeolocationClient:
+    # token - (optional) ipinfo.io token, enables the batch endpoint
+    # is_commerial - (optional) exclude the non-commercial suppliers
+    # timeout - (optional) the timeout of each request in seconds
+    # ipinfo_rate - (optional) the ipinfo.io requests allowed per minute
+    # ipapi_rate - (optional) the ip-api.com requests allowed per minute
+    # ipinfo_url, ipapi_url - (optional) the supplier endpoints
+    # pool_size - (optional) the number of keep-alive connections per supplier
+    # database - (optional) the offline GeoDatabase
+    # remote - (optional) query the suppliers for addresses the database misses
+    def __init__(self, token = '', is_commerial = True, timeout = g_request_timeout, ipinfo_rate = g_ipinfo_rate, ipapi_rate = g_ipapi_rate,
+            ipinfo_url = 'https://ipinfo.io', ipapi_url = 'http://ip-api.com', pool_size = g_resolver_workers, database = None, remote = True):
+        self._token = token if token else ''
+        self._is_commerial = is_commerial
+        self._database = database
+        self._remote = remote
+        self._ipinfo = SupplierClient(ipinfo_url, ipinfo_rate, timeout, pool_size=pool_size)
+        self._ipapi = SupplierClient(ipapi_url, ipapi_rate, timeout, pool_size=pool_size)
+    # the longest a single lookup or batch takes on the suppliers, the ip-api.com
+    # fall back follows a failed ipinfo.io request
+    def duration(self):
+        if not self._remote:
+            return 0.0
+        return self._ipinfo.duration() + (0.0 if self._is_commerial else self._ipapi.duration())
+    # the number of seconds for n lookups or batches to pass the rate limiters
+    def delay(self, n):
+        if not self._remote:
+            return 0.0
+        return max(self._ipinfo.delay(n), 0.0 if self._is_commerial else self._ipapi.delay(n))
+    # the number of addresses resolved by a single request
+    def batchSize(self):
+        return g_ipinfo_batch_size if self._token and self._remote else 1
+    def _params(self):
+        return {'token': self._token} if self._token else None
+
+    # the final answer for an address missing from the database when the
+    # suppliers are not queried, the unknown country is '--' as 'NA' is namibia
+    unlisted = {'city': 'NA', 'region': 'NA', 'country': '--'}
+
+    # returns the geolocation data of ip, unlisted or None if the suppliers
+    # failed
+    def lookup(self, ip):
+        if self._database != None:
+            data = self._database.lookup(ip)
+            if data != None:
+                return data
+            if not self._remote:
+                return GeolocationClient.unlisted
+        data = self._ipinfo.request('GET', f"/{ip}/json", params=self._params())
+        if isinstance(data, dict) and 'error' not in data:
+            return data
+        return self.fallback(ip)
+    # returns a dictionary of ip to geolocation data, the addresses the batch
+    # could not resolve are left out
+    def lookup_batch(self, ips):
+        results = {}
+        if self._database != None:
+            for ip in ips:
+                data = self._database.lookup(ip)
+                if data != None:
+                    results[ip] = data
+            ips = [ip for ip in ips if ip not in results]
+        if not ips:
+            return results
+        data = self._ipinfo.request('POST', '/batch', params=self._params(), json=list(ips))
+        if isinstance(data, dict):
+            results.update((ip, d) for ip, d in data.items() if isinstance(d, dict) and 'error' not in d)
+        return results
+    # fall back option if rate limit has been exceeded 
+    # the end-user has specified a non-commercial use case 
+    # exists
+    def fallback(self, ip):
+        if self._is_commerial or not self._remote:
+            return None
+        data = self._ipapi.request('GET', f"/json/{ip}", params={'fields': 'country,regionName,city,lat,lon,isp,as,query'})
+        if not isinstance(data, dict) or 'lat' not in data:
+            return None
+        data['loc'] = f"{data['lat']},{data['lon']}"
+        data['ip'] = data['query']
+        data['region'] = data['regionName']
+        data['hostname'] = data['isp']
+        data['org'] = data.get('as', '')
+        return data
+    def close(self):
+        self._ipinfo.close()
+        self._ipapi.close()
+        if self._database != None:
+            self._database.close()
+
+# resolver stage - performs the geolocation and reverse dns lookups for a cycle
+# on a bounded pool of worker threads
+class AddressResolver:
+    # client - the GeolocationClient
+    # workers - (optional) the maximum number of concurrent lookups
+    # timeout - (optional) the timeout of each request in seconds
+    def __init__(self, client, workers = g_resolver_workers, timeout = g_request_timeout):
+        self._client = client
+        self._workers = max(1, workers)
+        self._timeout = timeout
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='resolver')
+        self._lock = threading.Lock()
+        self._in_flight = {}
+    # completes a future unless it has been cancelled by the waiter
+    @staticmethod
+    def _complete(future, result = None, exception = None):
+        try:
+            if exception != None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+        except concurrent.futures.InvalidStateError:
+            pass
+    @staticmethod
+    def _settle(future, fn, *args):
+        if future.done():
+            return
+        try:
+            AddressResolver._complete(future, fn(*args))
+        except Exception as e:
+            AddressResolver._complete(future, exception=e)
+    # data - (optional) the geolocation data of a batch, the single lookup and
+    # the non-commercial fall back are used when it is missing
+    def _lookup(self, ip, data_t = None, batched = False):
+        if data_t == None:
+            data_t = self._client.fallback(ip) if batched else self._client.lookup(ip)
+
+        # only query the local resolver when the supplier has no hostname
+        hostname = None
+        if data_t == None or 'hostname' not in data_t:
+            hostname = NetworkUtils.reverse_dns(ip, self._timeout)
+        return data_t, hostname
+    def _lookup_batch(self, ips, futures):
+        try:
+            results = self._client.lookup_batch(ips)
+        except Exception:
+            results = {}
+        for ip in ips:
+            data_t = results.get(ip)
+            if data_t != None and 'hostname' in data_t:
+                AddressResolver._complete(futures[ip], (data_t, None))
+            else:
+                self._pool.submit(AddressResolver._settle, futures[ip], self._lookup, ip, data_t, True)
+    def _release(self, ip):
+        with self._lock:
+            self._in_flight.pop(ip, None)
+    # returns a dictionary of ip to the future of its lookup, sockets sharing
+    # the same remote address share a single lookup while it remains in flight
+    #
+    # with an ipinfo.io token the new addresses are resolved in batches
+    def submit_many(self, ips):
+        futures = {}
+        new = []
+        with self._lock:
+            for ip in ips:
+                future = self._in_flight.get(ip)
+                if future == None:
+                    future = concurrent.futures.Future()
+                    self._in_flight[ip] = future
+                    new.append(ip)
+                futures[ip] = future
+        for ip in new:
+            futures[ip].add_done_callback(lambda _, ip=ip: self._release(ip))
+        batch_size = self._client.batchSize()
+        if batch_size > 1:
+            for i in range(0, len(new), batch_size):
+                self._pool.submit(self._lookup_batch, new[i:i+batch_size], futures)
+        else:
+            for ip in new:
+                self._pool.submit(AddressResolver._settle, futures[ip], self._lookup, ip)
+        return futures
+    # the number of seconds to wait on n lookups
+    def deadline(self, n):
+
+        # worst case each worker performs its share of requests back to back
+        # with each waiting out the suppliers' retries and the local resolver,
+        # on top of the time the rate limiters take to let the requests through
+        requests = -(-n // self._client.batchSize())
+        rounds = -(-requests // self._workers)
+        return rounds * (self._client.duration() + self._timeout) + self._client.delay(requests)
+    # returns the (geolocation data, hostname) tuple of a completed lookup
+    @staticmethod
+    def result(future):
+        try:
+            return future.result()
+        except Exception:
+            return (None, None)
+    # resolve a collection of ip addresses, returns a dictionary of ip to the
+    # (geolocation data, hostname) tuple of each completed lookup
+    #
+    # lookups still in flight once the deadline has passed are left out of the
+    # result and are picked up again by the next cycle
+    def resolve(self, ips):
+        futures = self.submit_many(set(ips))
+        if not futures:
+            return {}
+        concurrent.futures.wait(futures.values(), timeout=self.deadline(len(futures)))
+        return {ip: AddressResolver.result(future) for ip, future in futures.items() if future.done()}
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._client.close()
+
+# negative cache - remembers the ip addresses whose lookup failed or was rate
+# limited so a failing supplier is not queried again on every cycle
+class NegativeCache:
+    # ttl - (optional) the number of seconds an entry remains in the cache
+    def __init__(self, ttl = g_negative_ttl):
+        self._ttl = ttl
+        self._expiry = {}
+    def __len__(self):
+        return len(self._expiry)
+    def __contains__(self, ip):
+        expiry = self._expiry.get(ip)
+        if expiry == None:
+            return False
+        if expiry < time.time():
+            del self._expiry[ip]
+            return False
+        return True
+    def add(self, ip):
+        self._expiry[ip] = time.time() + self._ttl
+    def discard(self, ip):
+        self._expiry.pop(ip, None)
+
+# interns a string value, None and other values are returned as they are
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
 
 # network ip address information
+#
+# records are slotted and their location strings interned, the same city,
+# region and country values are shared across the whole cache
 class IP_AddressInfo:
-    def __init__(self, ip_addr, hostname, city, region, country, location):
+    __slots__ = ('_ip_addr', '_hostname', '_city', '_region', '_country', '_location', '_log_time', '_asn')
+    def __init__(self, ip_addr, hostname, city, region, country, location, log_time = None, asn = ''):
         self._ip_addr = ip_addr
         self._hostname = hostname
-        self._city = city
-        self._region = region
-        self._country = country
-        self._location = location
-        self._log_time = time.time()
+        self._city = _intern(city)
+        self._region = _intern(region)
+        self._country = _intern(country)
+        self._location = _intern(location)
+        self._log_time = time.time() if log_time == None else log_time
+        self._asn = _intern(asn)
+    def __getstate__(self):
+        return (self._ip_addr, self._hostname, self._city, self._region, self._country, self._location, self._log_time, self._asn)
+    # pickles written by earlier releases hold the state as a dictionary
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            state = (state['_ip_addr'], state['_hostname'], state['_city'], state['_region'], state['_country'], state['_location'], state['_log_time'], state.get('_asn', ''))
+        self.__init__(*state)
     def __str__(self):
         return self._ip_addr +','+ self._hostname +',' + self._city + ','+ self._region + ',' + self._country +',' + self._location
     def ipAddress(self):
@@ -93,100 +1007,812 @@ class IP_AddressInfo:
         return self._location
     def logTime(self):
         return self._log_time
+    # the autonomous system, such as "AS15169 Google LLC", or '' when unknown
+    def asn(self):
+        return self._asn
+    def isResolved(self):
+        return self._country != '*'
+
+# persistent cache engine for IP_AddressInfo records keyed by ip address
+#
+# the records are loaded once at startup and held in memory in least recently
+# used order, each flush writes only new or changed records to an sqlite
+# database in a single transaction so an interrupted write never loses the
+# records committed before it
+class CacheStore:
+    # path - (optional) the sqlite database file
+    # max_entries - (optional) the size cap before records are evicted
+    # legacy_path - (optional) a pickle cache from earlier releases to import
+    def __init__(self, path = 'info_cache.db', max_entries = g_cache_max_entries, legacy_path = 'info_cache'):
+        self._path = path
+        self._max_entries = max(1, max_entries)
+        self._records = collections.OrderedDict()
+        self._last_used = {}
+        self._dirty = set()
+        self._touched = set()
+        self._evicted = set()
+
+        # the records are shared between the daemon stages, the lock guards
+        # the in memory state and the database is written from any thread
+        self._lock = threading.RLock()
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS ip_address_info (ip TEXT PRIMARY KEY, hostname TEXT, city TEXT, region TEXT, country TEXT, location TEXT, log_time REAL, last_used REAL) WITHOUT ROWID')
+
+        # databases created before the autonomous system was recorded
+        if 'asn' not in [c[1] for c in self._db.execute('PRAGMA table_info(ip_address_info)')]:
+            self._db.execute("ALTER TABLE ip_address_info ADD COLUMN asn TEXT DEFAULT ''")
+        self._db.commit()
+        for row in self._db.execute('SELECT ip, hostname, city, region, country, location, log_time, last_used, asn FROM ip_address_info ORDER BY last_used'):
+            self._records[row[0]] = IP_AddressInfo(row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[8])
+            self._last_used[row[0]] = row[7]
+        self._evict()
+        if legacy_path and os.path.isfile(legacy_path):
+            self._import_legacy(legacy_path)
+    def __len__(self):
+        return len(self._records)
+    def __contains__(self, ip):
+        return ip in self._records
+    # returns the record for ip or None, marking the record as recently used
+    def get(self, ip):
+        with self._lock:
+            info = self._records.get(ip)
+            if info != None:
+                self._records.move_to_end(ip)
+
+                # the usage time is only persisted with an hourly granularity
+                # to keep steady state cycles free of writes
+                if self._last_used[ip] < time.time() - 3600:
+                    self._touched.add(ip)
+            return info
+    def put(self, ip, info):
+        with self._lock:
+            self._records[ip] = info
+            self._records.move_to_end(ip)
+            self._last_used[ip] = time.time()
+            self._dirty.add(ip)
+            self._evicted.discard(ip)
+            self._evict()
+    # evicts the least recently used records beyond the size cap
+    def _evict(self):
+        while len(self._records) > self._max_entries:
+            evicted, _ = self._records.popitem(last=False)
+            del self._last_used[evicted]
+            self._dirty.discard(evicted)
+            self._touched.discard(evicted)
+            self._evicted.add(evicted)
+    def items(self):
+        return self._records.items()
+    def values(self):
+        return self._records.values()
+    # writes the new, changed and evicted records to disk, returns the number
+    # of records written
+    def flush(self):
+        with self._db_lock:
+
+            # collect the changes under the lock and write them outside of it
+            # so readers are only held up for the collection
+            with self._lock:
+                if not self._dirty and not self._touched and not self._evicted:
+                    return 0
+                now = time.time()
+                for ip in self._touched:
+                    self._last_used[ip] = now
+                rows = []
+                for ip in self._dirty:
+                    i = self._records[ip]
+                    rows.append((ip, i.hostname(), i.city(), i.region(), i.country(), i.location(), i.logTime(), self._last_used[ip], i.asn()))
+                touched = [(now, ip) for ip in self._touched - self._dirty]
+                evicted = [(ip,) for ip in self._evicted]
+                self._dirty.clear()
+                self._touched.clear()
+                self._evicted.clear()
+            with self._db:
+                self._db.executemany('INSERT OR REPLACE INTO ip_address_info (ip, hostname, city, region, country, location, log_time, last_used, asn) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                self._db.executemany('UPDATE ip_address_info SET last_used = ? WHERE ip = ?', touched)
+                self._db.executemany('DELETE FROM ip_address_info WHERE ip = ?', evicted)
+            return len(rows) + len(evicted)
+    def close(self):
+        self.flush()
+        with self._db_lock:
+            self._db.close()
+    # removes the database once its contents have been exported
+    def destroy(self):
+        with self._db_lock:
+            self._db.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.isfile(self._path + suffix):
+                os.remove(self._path + suffix)
+    # pickle caches written by earlier releases are imported once and kept as
+    # a backup
+    def _import_legacy(self, path):
+        try:
+            with open(path, 'rb') as data_t:
+                info_list = CacheStore._migrate(pickle.load(data_t))
+        except:
+            print('the legacy cache data file could not be read and has been skipped')
+            info_list = {}
+        for ip, info in sorted(info_list.items(), key=lambda t: t[1].logTime()):
+            if ip not in self._records or self._records[ip].logTime() < info.logTime():
+                self.put(ip, info)
+        self.flush()
+        os.replace(path, path + '.bak')
+    # caches written before records were keyed by ip address used "ip:port"
+    # keys, these are folded into a single record per ip keeping the latest
+    @staticmethod
+    def _migrate(info_list):
+        migrated = {}
+        for key, info in info_list.items():
+            ip = key
+            if key != info.ipAddress():
+                ip = key.rpartition(':')[0]
+                info._ip_addr = ip
+            if ip not in migrated or migrated[ip].logTime() < info.logTime():
+                migrated[ip] = info
+        return migrated
+
+# connection history - each sweep appends the connections it first saw, those
+# it found closed and the ip address information of their remote addresses to
+# a segment file per day (utc), older segments are compacted into a single
+# block and deleted once past the retention period
+#
+# a segment is the magic followed by blocks of a (payload length, time,
+# connection count, info count) header and a zlib compressed json payload of
+# the connection, info and closed connection columns. a segment starts with
+# the connections still open and the info of an address is written to each
+# segment referencing it, so a segment can be queried on its own
+class HistoryStore:
+    _magic = b'NLHIST01'
+    _header = struct.Struct('=IdII')
+
+    # the columns of the connection, info and closed connection records, the
+    # time of a connection is when it was first seen
+    _conn_columns = ('time', 'type', 'local_ip', 'local_port', 'remote_ip', 'remote_port', 'state', 'pid')
+    _info_columns = ('ip', 'hostname', 'city', 'region', 'country', 'location', 'asn', 'log_time')
+    _closed_columns = _conn_columns + ('last_seen',)
+
+    # path - (optional) the directory of the segment files
+    # retention_days - (optional) the number of days of history kept
+    def __init__(self, path = 'history', retention_days = g_history_days):
+        self._path = path
+        self._retention_days = retention_days
+        self._day = None
+
+        # the remote addresses referenced by the current segment and the info
+        # written for each, None until the address has resolved
+        self._refs = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _day_of(t):
+        return time.strftime('%Y-%m-%d', time.gmtime(t))
+
+    def _segment(self, day):
+        return os.path.join(self._path, day + '.seg')
+
+    # returns the sorted list of (day, path) segments from the day of start
+    # onwards, or every segment when start is omitted
+    def segments(self, start = None):
+        try:
+            names = os.listdir(self._path)
+        except FileNotFoundError:
+            return []
+        first = HistoryStore._day_of(start) if start != None else ''
+        days = sorted(n[:-len('.seg')] for n in names if n.endswith('.seg'))
+        return [(day, self._segment(day)) for day in days if day >= first]
+
+    # delete the segments past the retention period and compact those of
+    # earlier days
+    def maintain(self, now = None):
+        now = time.time() if now == None else now
+        expired = HistoryStore._day_of(now - self._retention_days * 86400)
+        today = HistoryStore._day_of(now)
+        for day, path in self.segments():
+            if day < expired:
+                os.remove(path)
+            elif day < today:
+                self.compact(path)
+
+    # rewrite a segment as a single block, the info of each address is kept
+    # once, returns True if the segment was rewritten
+    def compact(self, path):
+        blocks = list(HistoryStore._blocks(path))
+        if len(blocks) < 2:
+            return False
+        conns = [[] for _ in HistoryStore._conn_columns]
+        closed = [[] for _ in HistoryStore._closed_columns]
+        infos = {}
+        for _, block_conns, block_infos, block_closed in blocks:
+            for column, values in zip(conns, block_conns):
+                column.extend(values)
+            for column, values in zip(closed, block_closed):
+                column.extend(values)
+            for row in zip(*block_infos):
+                infos[row[0]] = row
+        info_columns = [list(column) for column in zip(*infos.values())] if infos else [[] for _ in HistoryStore._info_columns]
+
+        _write_atomic(path, (HistoryStore._magic, HistoryStore._block(blocks[-1][0], conns, info_columns, closed)))
+        return True
+
+    @staticmethod
+    def _block(t, conns, infos, closed):
+        payload = zlib.compress(json.dumps([conns, infos, closed], separators=(',', ':')).encode('utf-8'))
+        return HistoryStore._header.pack(len(payload), t, len(conns[0]), len(infos[0])) + payload
+
+    # generator of the (time, connection columns, info columns, closed
+    # connection columns) blocks of a segment, a block cut short by a crash
+    # ends the segment
+    @staticmethod
+    def _blocks(path):
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            for _, t, conns, infos, closed in HistoryStore._read(f):
+                yield t, conns, infos, closed
+
+    # generator of the (end offset, time, connection columns, info columns,
+    # closed connection columns) blocks of an open segment
+    @staticmethod
+    def _read(f):
+        header = HistoryStore._header
+        if f.read(len(HistoryStore._magic)) != HistoryStore._magic:
+            return
+        while True:
+            head = f.read(header.size)
+            if len(head) < header.size:
+                return
+            size, t, _, _ = header.unpack(head)
+            payload = f.read(size)
+            if len(payload) < size:
+                return
+            try:
+                columns = json.loads(zlib.decompress(payload))
+
+                # blocks written before closed connections were recorded
+                # hold two groups of columns
+                if len(columns) == 2:
+                    columns.append([[] for _ in HistoryStore._closed_columns])
+                conns, infos, closed = columns
+            except (zlib.error, ValueError, TypeError):
+                return
+            yield f.tell(), t, conns, infos, closed
+
+    # truncate a segment to the end of its last valid block, a block cut short
+    # by a crash would otherwise hide the blocks appended behind it, returns
+    # the number of bytes dropped
+    @staticmethod
+    def _repair(path):
+        try:
+            f = open(path, 'r+b')
+        except FileNotFoundError:
+            return 0
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            end = 0
+            for end, _, _, _, _ in HistoryStore._read(f):
+                pass
+
+            # a segment with no valid block keeps its magic, unless the magic
+            # itself is cut short or belongs to another file
+            if end == 0:
+                f.seek(0)
+                magic = f.read(len(HistoryStore._magic))
+                if magic == HistoryStore._magic:
+                    end = len(magic)
+                elif not HistoryStore._magic.startswith(magic):
+                    return 0
+            if end < size:
+                f.truncate(end)
+                print('dropped '+ str(size - end) +' bytes of an incomplete block from '+ path)
+            return size - end
+
+    # returns True when a block appended at now starts a segment, which is
+    # then passed the live connections
+    def starts_segment(self, now):
+        return HistoryStore._day_of(now) != self._day
+
+    @staticmethod
+    def _row(c):
+        return (int(c.time()), int(c.connectionType()), c.localIP(), c.localPort(), c.remoteIP(), c.remotePort(), c.status(), c.pid())
+
+    # the columns identifying a connection across records, all but the state
+    # which changes
+    @staticmethod
+    def _identity(row):
+        return row[:6] + (row[7],)
+
+    # append a block to the segment of the day
+    # now - the time of the block
+    # conns - the SocketConnection objects first seen since the last block
+    # infos - the IP_AddressInfo records resolved since the last block or of
+    # the remote addresses of conns, closed and live
+    # closed - (optional) the SocketConnection objects closed since the last
+    # block
+    # live - (optional) the SocketConnection objects still open, written with
+    # conns when the block starts a segment
+    def append(self, now, conns, infos, closed = (), live = ()):
+        with self._lock:
+            day = HistoryStore._day_of(now)
+            if day != self._day:
+
+                # a new segment starts with no addresses referenced, the
+                # earlier segments are compacted in passing
+                if self._day != None:
+                    self.maintain(now)
+                self._day = day
+                self._refs = {}
+
+                # the segment of the day may end in a block cut short by a
+                # crash, which is dropped before appending behind it
+                HistoryStore._repair(self._segment(day))
+
+                # the connections opened on earlier days are carried into
+                # the segment
+                first = {id(c) for c in conns}
+                conns = list(conns) + [c for c in live if id(c) not in first]
+
+            refs = self._refs
+            conn_columns = [[] for _ in HistoryStore._conn_columns]
+            for c in conns:
+                for column, value in zip(conn_columns, HistoryStore._row(c)):
+                    column.append(value)
+                refs.setdefault(c.remoteIP(), None)
+            closed_columns = [[] for _ in HistoryStore._closed_columns]
+            for c in closed:
+                for column, value in zip(closed_columns, HistoryStore._row(c) + (int(c.lastSeen()),)):
+                    column.append(value)
+                refs.setdefault(c.remoteIP(), None)
+
+            # only the resolved info of referenced addresses is written, and
+            # only once for each record
+            info_columns = [[] for _ in HistoryStore._info_columns]
+            for i in infos:
+                if i == None or not i.isResolved() or i.ipAddress() not in refs or refs[i.ipAddress()] is i:
+                    continue
+                refs[i.ipAddress()] = i
+                for column, value in zip(info_columns, (i.ipAddress(), i.hostname(), i.city(), i.region(), i.country(), i.location(), i.asn(), i.logTime())):
+                    column.append(value)
+            if not conn_columns[0] and not info_columns[0] and not closed_columns[0]:
+                return 0
+
+            os.makedirs(self._path, exist_ok=True)
+            path = self._segment(day)
+            block = HistoryStore._block(now, conn_columns, info_columns, closed_columns)
+            with open(path, 'ab') as f:
+                if f.tell() == 0:
+                    f.write(HistoryStore._magic)
+                f.write(block)
+            return len(block)
+
+    # returns the (connection columns, dictionary of info rows keyed by ip,
+    # closed connection columns, time of the last block) of a segment
+    @staticmethod
+    def _load(path):
+        conns = [[] for _ in HistoryStore._conn_columns]
+        closed = [[] for _ in HistoryStore._closed_columns]
+        infos = {}
+        last = None
+        for last, block_conns, block_infos, block_closed in HistoryStore._blocks(path):
+            for column, values in zip(conns, block_conns):
+                column.extend(values)
+            for column, values in zip(closed, block_closed):
+                column.extend(values)
+            for row in zip(*block_infos):
+                infos[row[0]] = row
+        return conns, infos, closed, last
+
+    # returns the (connection record, info record) of the first connection to
+    # an ip address or hostname, or None if there has been none, the records
+    # are dictionaries keyed by their column names and the info is None for
+    # unresolved addresses
+    def first_seen(self, target):
+        target = target.lower()
+        for _, path in self.segments():
+            conns, infos, _, _ = HistoryStore._load(path)
+            matches = {ip for ip, info in infos.items() if info[1].lower() == target}
+            matches.add(target)
+            first = None
+            for row in zip(*conns):
+                if row[4] in matches and (first == None or row[0] < first[0]):
+                    first = row
+
+            # the segments are in day order, the first with a match holds the
+            # earliest connection
+            if first != None:
+                info = infos.get(first[4])
+                return dict(zip(HistoryStore._conn_columns, first)), None if info == None else dict(zip(HistoryStore._info_columns, info))
+        return None
+
+    # the columns the history can be filtered and grouped by
+    _fields = ('country', 'asn', 'host', 'remote_port', 'state')
+
+    # returns the Counter of the connections open at any time over the last
+    # hours grouped by one of _fields, or by total when omitted, a connection
+    # is open from when it was first seen until it was last seen
+    # filters - the _fields values the connections must match, the state is
+    # the last recorded
+    def count(self, hours, by = None, now = None, **filters):
+        now = time.time() if now == None else now
+        start = now - hours * 3600
+        today = HistoryStore._day_of(now)
+        rows = {}
+        until = {}
+        infos = {}
+        for day, path in self.segments(start):
+            conns, segment_infos, closed, last = HistoryStore._load(path)
+            infos.update(segment_infos)
+
+            # a connection with no close record is open at the last block of
+            # the latest segment holding it, or until now in today's segment,
+            # the segments are in day order
+            for row in zip(*conns):
+                key = HistoryStore._identity(row)
+                rows[key] = row
+                until[key] = now if day >= today else last
+            for row in zip(*closed):
+                key = HistoryStore._identity(row)
+                rows[key] = row
+                until[key] = row[8]
+        return HistoryStore._tally((rows[key] for key, t in until.items() if t >= start), infos, by, filters)
+
+    # returns the Counter of the new connections, those first seen in the last
+    # hours, grouped by one of _fields, or by total when omitted, connections
+    # which were already open at the start of the window are not counted
+    # filters - the _fields values the connections must match, the state is
+    # the first seen
+    def count_new(self, hours, by = None, now = None, **filters):
+        now = time.time() if now == None else now
+        start = now - hours * 3600
+        rows = {}
+        infos = {}
+        for _, path in self.segments(start):
+            conns, segment_infos, _, _ = HistoryStore._load(path)
+            infos.update(segment_infos)
+
+            # connections carried into later segments are counted once
+            for row in zip(*conns):
+                if row[0] >= start:
+                    rows.setdefault(HistoryStore._identity(row), row)
+        return HistoryStore._tally(rows.values(), infos, by, filters)
+
+    # returns the Counter of connection rows grouped by one of _fields
+    # infos - the dictionary of info rows keyed by ip
+    @staticmethod
+    def _tally(rows, infos, by, filters):
+        fields = HistoryStore._fields
+        matches = [(fields.index(k), str(v).lower()) for k, v in filters.items() if v != None]
+        group = fields.index(by) if by != None else None
+        counts = collections.Counter()
+
+        # the (country, asn, host) of each address are worked out once
+        remotes = {}
+        for row in rows:
+            rip = row[4]
+            remote = remotes.get(rip)
+            if remote == None:
+                info = infos.get(rip)
+                if info == None:
+                    remote = ('*', '*', rip)
+                else:
+                    remote = (info[4], info[6] or '*', rip if info[1] == 'NA' else info[1])
+                remotes[rip] = remote
+            values = remote + (row[5], row[6])
+            if matches and any(str(values[idx]).lower() != v for idx, v in matches):
+                continue
+            counts[values[group] if group != None else 'total'] += 1
+        return counts
+
+# report summary - the connections grouped by remote country, asn, host, port
+# and state in a single pass, along with the remote addresses which are new
+# since the previous sweep
+#
+# each remote address is looked up in the cache once however many connections
+# it has, the records are kept in infos for the report rows
+class ReportSummary:
+    # size - (optional) the number of rows of each summary table
+    def __init__(self, size = g_summary_rows):
+        self.size = size
+        self.infos = {}
+        self.connections = 0
+        self.countries = collections.Counter()
+        self.asns = collections.Counter()
+        self.hosts = collections.Counter()
+        self.ports = collections.Counter()
+        self.states = collections.Counter()
+        self.new_remotes = []
+
+        # the remote addresses of the last report and of the last report of
+        # an earlier sweep, the baseline of the new remote addresses
+        self._sweep = None
+        self._remotes = None
+        self._baseline = None
+
+    # cl - dictionary of SocketConnection objects
+    # il - dictionary of IP_AddressInfo objects keyed by ip address
+    def update(self, cl, il):
+        remotes = {}
+        ports = collections.Counter()
+        states = collections.Counter()
+        sweep = None
+        for c in cl.values():
+            ip = c.remoteIP()
+            remotes[ip] = remotes.get(ip, 0) + 1
+            ports[c.remotePort()] += 1
+            states[c.status()] += 1
+            sweep = c.lastSeen()
+
+        countries = collections.Counter()
+        asns = collections.Counter()
+        hosts = collections.Counter()
+        infos = {}
+        for ip, n in remotes.items():
+
+            # the lookup may still be in flight for new connections
+            i = il.get(ip)
+            infos[ip] = i
+            if i == None or not i.isResolved():
+                countries['*'] += n
+                asns['*'] += n
+                hosts[ip] += n
+                continue
+            countries[i.country()] += n
+            asns[i.asn() or '*'] += n
+            hosts[ip if i.hostname() == 'NA' else i.hostname()] += n
+
+        # every connection in the table was seen by the latest sweep, the
+        # baseline moves on once a report of a later sweep is produced
+        if sweep != self._sweep:
+            self._baseline = self._remotes
+            self._sweep = sweep
+        self._remotes = remotes
+        baseline = self._baseline
+        self.new_remotes = [] if baseline == None else [ip for ip in remotes if ip not in baseline]
+
+        self.infos = infos
+        self.connections = len(cl)
+        self.countries = countries
+        self.asns = asns
+        self.hosts = hosts
+        self.ports = ports
+        self.states = states
+        return self
+
+    # returns the list of (title, [(key, count)]) summary tables
+    def tables(self):
+        return [
+            ('Country', self.countries.most_common(self.size)),
+            ('ASN', self.asns.most_common(self.size)),
+            ('Remote Host', self.hosts.most_common(self.size)),
+            ('Remote Port', self.ports.most_common(self.size)),
+            ('State', self.states.most_common(self.size)),
+            ('New Remotes (' + str(len(self.new_remotes)) + ')', [(ip, self._remotes[ip]) for ip in self.new_remotes[:self.size]])]
 
 # report writer
 class ReportWriter:
-    # cl - dictionary of SocketConnection objects
-    # il - dictionary of IP_AddressInfo objects
-    # mr - (optional) produce multiple document reports
+
+    # the number of rows joined into the buffer at a time
+    _batch_size = 1000
+
+    # the static parts of the document, compiled once per process
+    _logo = "iVBORw0KGgoAAAANSUhEUgAAAEYAAAA1CAYAAAD8mJ3rAAABhGlDQ1BJQ0MgcHJvZmlsZQAAKJF9kT1Iw1AUhU9TtaIVBzuoOGSoTnZREcdSxSJYKG2FVh1MXvoHTRqSFBdHwbXg4M9i1cHFWVcHV0EQ/AFxdnBSdJES70sKLWK84ZGP8+45vHcfIDQqTDW7ooCqWUYqHhOzuVUx8IoejMBHX7/ETD2RXszAs77uqY/qLsKzvPv+rAElbzLAJxJHmW5YxBvEs5uWznmfOMRKkkJ8Tjxp0AGJH7kuu/zGueiwwDNDRiY1TxwiFosdLHcwKxkq8QxxWFE1yheyLiuctzirlRprnZPfMJjXVtJcpzWGOJaQQBIiZNRQRgUWIvTXSDGRov2Yh3/U8SfJJZOrDEaOBVShQnL84G/we7ZmYXrKTQrGgO4X2/4YBwK7QLNu29/Htt08AfzPwJXW9lcbwNwn6fW2Fj4CBreBi+u2Ju8BlzvA8JMuGZIj+WkJhQLwfkbPlAOGboG+NXdurX2cPgAZmtXyDXBwCEwUKXvd4969nXP7t6c1vx8sBHKK8ql/LgAAAAZiS0dEAP8A/wD/oL2nkwAAAAlwSFlzAAAuIwAALiMBeKU/dgAAAAd0SU1FB+gGGQELERwUTfQAAAAZdEVYdENvbW1lbnQAQ3JlYXRlZCB3aXRoIEdJTVBXgQ4XAAAOSklEQVRo3u2be5TV1XXHP+feGcARBgQVUEEN4iP4ADVKCBFsHqVJVrtcNdGk0SY2taYlmqZpumpdNq1xNWmNIUlpUzVpU21iijWaNGlsfdwaWQ0GUWR4CCIzIILyEMS54DD39+0f93uYzY9BUPGRtThr3TXzu+ecffZvn72/e5999oUD2CRNlXSfpKclbZHUK6lT0uQDQPtESbeb3vOSevz3Yl6HVjnA9DqA7wBHAEOBKrAC2HgAaK8B7gC2A8OAVv//y7e8YFJKW4CHgEb4+okDIZiU0nZgEfBcViLgKaDzLS8YSQmYEOgWwAoL7EC0UdZGLPyHLKC3vCkl4NxAd/0B3tGxwDFBMA++XoJpCbvdDkwDjgMOAQYBOyR9M6UEMBGYbux4ArgrpfR8P4KZbGwBeBpY3Y9WtQLHAlOBt5mPjcDPgeXA+4CjgVtTSps8r9Vjh5jUVmABcJik84CzLKT7gHkppR2ldVuBkV7zFL9fw+s+CTyWUlrdnxmMkvR1Sc8a8V+S9KCkcZJukLROUt19dUn/IamtRGOEpNXqa3dIGh6FIul4SX8rab0913JJ80x/o6TF/v4xSePC3NGS/i3Q/i9JUyT9VNJmSdvN2xZJn5BUDXMPlfRZSV2Stkla4TWfkvSi5z74chgxXtJ/e+GGpNsk/bOk+yVdb2KF+zdKmlaa/x5Jm9zfK+nvSkI5yS8kM/NtScdJGiDpM4G27JpHhvmnS3ok9N8paa6F/9eSHg59SyUNC3Mvl7TB9B+VdKK/P0fSfM+Z3a8puR0KtAezONPq+smUUpekXpvUAOPI0NL8s4GB/n8zsCz0tQN/Bczwcw24PqXUWRRFSimV3e7jwLbwfCRwYnieBswCvppSqkvaApxh3o6x2S2QNNRjD7cz6EgpLbene1jSjwwdD7wc+I4ywOX2InBtSqkrvFxLAL91+xDM0tD3IX+wXd+RUnrKDCbHJrnttFC3e2cHACcAg8OYu4Gvp5Tqft4O9IT+TK/Nn13OQdL5Ydx3gcuNTXsKptFoJAtldHC1N2WvIukw70Se80LUCEkjApACbMr9RVG0AJ/wzuCgrxb4qNrN59YFrEspZY8z2JpKEPrskkYNCfQV+jYYXHstmHHA30v6nKThKaWulNLcsiPZJZhKpTLUaJ1bN3BvSqnw87HAmCC0xz0mtwnAYf6/F1iVUtpsjXi7d7xiTVueUlpZMul3mXHsmZ4tmXgUzANAVxacpIHe0GrQuC6v3Qt82659p3k4xWZ9k6S37yuOGQbEQYvsEnM7LphZA5hXiiFODZhTBx4rCe3QYJ4dJT6GA1PC85Mhws28RY2aazq5HQWMD9qy1Bodo+/LgH8JdAcDvw1cLWn0ywlmeGnx+dlmi6LIKhjN7BclWqcG4K4Dj4a+kY5dMhZ0lkz4IwETdgJPppRetDa0mK/BoX9RKU45wcCb239aa/NxQsbJTwMzS9h3AXB8vwGeff4xDqr2EExKaThwUuh7HlgSVHm4ibcErVgYxreGTeiNmlipVE4Dft/eBOAZYFVp7jnheT2wJWDbYAeeOSLuBO4CCknHOVicm1JaklJqSLrTJvuDCM6NRiNVq1WVNWYQMCksXgeW2T3j88nJoX9JCV9OsEfL2tSVUooHxy1hBzMeIOkM4DoDZRFefE1JMOeG5558SHUUfSbwO4Hvr1qwrcAH7UA+ahwipdQo0d8IbI1CiXHMIIfU0SY3VyoVhRgiArMCUFIyMwAVRVGtVCr5lP0La8lwA/TnJc2wFj5gwZwZXGp6GXw5Cjhb0nrz/Bd2DC8ANwLfSym9ZC3O7/RhYImk+z3/qrCJtwEr9xbxHu0wuS5ph6RbJB2RbVzSx/x93Z+NkuYURdHmMV9waF2X1O0o81t28Uiq2j1uDHRWS7rGof6DYf4WST+SdIqj5Q9I2ippiaQf+ijxjPld42TVA5IukDTYWoSkIx0dd5v2Wh8/VnlOl6RrvX7q7zSc3d3pwbTWAWttkxWD59jS3JwfwW68jOwvSFpRqVR6Q5B2itep2913SlJK6dQQGGbaK1NK3fYYZzn26fRapxno6wbSlUCPzSQeVg+xto83HLTaDJ+R1OHYpTfESwfbwXawHWwH25vZ0muZXJ8+PUfMg4E1bbXaC6+STsWR8yFAV1uttu1V0ml19D4EWNVWq734mgRTnz69xe6y3laraT8ZOBf4rM8oFacCbve90pb9pFN1Emmmg7ic+70duK2tVtuwnwIZYH6udARfCXS+A2x9Bfy0AD1ZMBMcDf4T8FhbrdbYy8Rk7bgC+Lyj0sKfFh/wfg78GbC0rVbb+TJ0DvOJ90rHSQ1H1C0+PtwLfBF4fB/8DAUuBa42zchPj/n5ArCsrVbr3QedP3LG8t4smNOdEet2nuKesllYq8YBfw5cCOwAFjuk3+IgbLIDsFUO1e/dC50TvRGXes0O50s2ecffbRNdBlwLPNAPnVanQq7x6TwHjf/rI8bEwM9Kj7u3bKbm5yTgj33m+hTw71kwR5mBi7xr3/IJtdNSH+ET7lUWwELgFuBf22q1eljkbC/wAX91EzDHVyg9jj7PtJZMNp1/BL6f8cB4M8lmmlOhs83P6sBPNuVJpnOzza+7xM/ngN+wRt4M3On32uk88DnWlMzPTGBeCkSGO/34h9aMDqtVt1OW7zQO3QXc0Farzd+LWrY7h/oHPnUvoXm/XPfzOx2a/xD4Wlut9vBe6IwwPzOtGYvMT938TXGq4k5gVlutNm8vdIZZCz7t91hsfrb7eaozf3cDNwAL2mq1IpWIDHJu4zPO5sdEVqcl/t22Wm3tfoDz+y3k95duI9ZYI29tq9XW7IPOQOC93tEZJS/aaUy8dT/4Gei8zEzTq4bu1ebntshP2gsQHQecB5xv17cIuMdA2P0KXfk002m39vwE6NhfV2p+jreGvMd0FhmcF0RT3g9+xpiX8/xeHcDP+uMn7cMFHmrpbt9fV74POjuA7ldJp9UeMfOzva1WK94sfg62g+0AHgnejObE2UCbQk6DFkA93IHl6ob8fo2YxNqf1vIruJnH2vVOMYC2OoF+Ec1bx3zl8nHnd1+iees5/43cvaqkdknDnG+tvAFrHirpUkkrXaVQOGdcCWNOkNTh/k2SPvRK13mtGvM2R5atNG8C5rD77eWBt/1mHngJfXdLvex5K3qGo1qsMY++YYKRNMjB2xX+agN9d0OvdzsmvHgve96KPu5gbiCwTdK61yQYZ9aTI95qALbCO1KklORxI4BLAnNLgO2+1SxMowzujXB7mUpjGv1l620iuz6SXmL3C74e4JfmK49bRbOiE6AI92N7oxvfs0gp9d2n+IUmGLR+zSmFPHG91XW2Q+iJPjZ8JKQblvl03O2D5CcNkC1ZqA7tF/slznKqYKT7vgTcl72H+RlN87Lstwy6hU11iIWDteW95uECr91OX03MjcA3w4a0GJQv9jFjrHnc4RP+bJ+nmtJzmVgGrHmSrnAt2z3+bqFLs851idjaUNrVKekul4d9wwB5lqRaGLNW0piwER91zZx8CTcpXJa1Snqf+djpy7HrJF3iSzcF4J2Vr19dA3hz6K9LmlGi+0FJj3vthZKulDTTJWiS9ISkczKTh0u6KRC8MKO8pHf4pX4gaWzwDB1h/I2+UIuqOso1fLnd7eKiPP8vQ9+SXIrh28d3uzgxe5WLAz8XunAyC+aiUiHidYHuc7HEw8JeGjZqaui7xnWHknR7dnFD7GFym8Tu1U9XWcVyMc8JPmjipNDylFJPyYyHOD2QWz7qw5730fOtytC8OfwUfWUdc4CfxOAt4FK3gbbwyw1n94qNxdl7STradE+2ac8xPOT2fODh/JawQFcYdDkwTNKslNIKmjX8EaCnBuBeS7MIoNwOY/dCpEfCwkNp1tNEwWw37ZONKZmvOf6b8WEUfbU2S4HNAbRHh80Q8H/0le9P9Ok8O4vb2b20fxB9pSiDs8ZsBL5vz4Jd4WXAHb7QT6XdelfIaayhWRpGKRw/ib5ColU078ILFyEdTl8FVK8zZy9ZS6fQV5n1CNAZtGVYPwKNBURHlQQzD2hIOsQaOMJ9S2iWqhQAjUajak3Nm72h4qCpAO63pvyMZuHPQJqX59cZ7XM7xOnNFqtwZ0qpnCjKY2JckevxBprJzMRyYIN3fRB95SB5XiwaPILda2XmZ/O0wMcEU+qmWXnV8AaND/MeDWZNpVIZGaBBwCOVEFEWKaW5dmNf9oskY88FRVFkDTkt7OgW+ioeKKllFMyiEKm2A78e+jpCXyt9lVE5u9YdtHBSwJ46sDRjW0ppaAm3HqOvTm8AfYWTOMaJNxhjw9wG8OOKq8EvkTTBC2wtiuJv7NOzDbanlDIYn0JfycY2moWESBricvh8RxXx5amU0ovu+81g67sBpDdiUOjb2mg08guMdxI9BXzZFMYO86b1h2kNmyphQxslgedSuoXA/1SAj/lS6rI8q1qtFoFQT36x4G2yplWAqqQjgT8BrrcdV9m9arzFFdq/5wT3mpLQ6gFvolmOq1arQyS9w9cfESxXsHudb1kwHUEwZc0eGd5hvIPaFpoVnV8BNrQED3OBpM0GponOjWZkvyUQXegF273Al63uQ2iWsG/zootpFgkB/Cnwu1b/f7AAd6UR/MuXbVb9n/r6JfneaYox6z4zPiWcl8ZIyuWpx4djQtbswyWtc0n9j50QP89wsU5S3f9PtoO43qFBD5K+6N8xrnJA9Jx/CTJP0tWSji0d6Qc6Kn7C0eOzkr7noGxgiDBnSFrgMU/7ly0nSzrTUeYif+ZKmuYURnLp1w0O7OqSHpL0YUljJc12YLnIP7iY5ZTHIP+QYnGJ7sdtvjlFMkHS15yy2Oggb4Gkr5ivXVVd/w/7ZuBOGA4Z0AAAAABJRU5ErkJggg=="
+    _style = ('<style type="text/css">'
+        "body{margin:0;padding:20px 0px 0px 20px;background-color:#000000;color:#ffffff;font-size:13px;}"
+        "h1{font-size:20px;padding:0;margin:0;color:#ffffff;}"
+        ".pl{padding-left:20px;}"
+        "p{font-size:20px;margin:0px;padding:0px;}"
+        "th{cursor:pointer;}"
+        ".mt{margin-top:10px;}"
+        "a{color:#F5428A;}"
+        "</style>")
+    _script = ('<script type="text/javascript">'
+        "var gcv = function(tr, idx){ return tr.children[idx].innerText || tr.children[idx].textContent; };var c = function(idx, asc) { return function(a, b) { return function(v1, v2) {return v1 !== '' && v2 !== '' && !isNaN(v1) && !isNaN(v2) ? v1 - v2 : v1.toString().localeCompare(v2);}(gcv(asc ? a : b, idx), gcv(asc ? b : a, idx));}};window.onload = function(){Array.prototype.slice.call(document.querySelectorAll('th')).forEach(function(th) { th.addEventListener('click', function() {var table = th.parentNode;while(table.tagName.toUpperCase() != 'TABLE') table = table.parentNode;Array.prototype.slice.call(table.querySelectorAll('tr:nth-child(n+2)')).sort(c(Array.prototype.slice.call(th.parentNode.children).indexOf(th), this.asc = !this.asc)).forEach(function(tr) { table.appendChild(tr) });})});};"
+        "var nlabs_more = function(src){var s = document.createElement('script');s.src = src;document.body.appendChild(s);var p = document.getElementById('more');p.parentNode.removeChild(p);return false;};"
+        "var nlabs_rows = function(rows){var b = document.getElementById('connections').tBodies[0];while(b.rows.length > 1) b.deleteRow(1);b.insertAdjacentHTML('beforeend', rows.join(''));};"
+        "</script>")
+    _banner = ("<body>"
+        '<table id="data_table">'
+        '<tr valign="top" cellspacing="10">'
+        '<td><a href="https://www.nlabs.studio" target="_blank"><img src="data:image/png;base64,' + _logo + '" alt="" /></a></td>'
+        '<td class="pl"><h1>NLabs.Studio Snapshot Report</h1><p class="mt">Autonomous network monitoring reports for TCP/UDP connections active on the (NIC) network interface card.</p></td>'
+        "</tr>"
+        "</table>"
+        "<br />")
+    _table_head = ('<table id="connections" cellspacing="10">'
+        "<tr>"
+        '<th align="left">Local</th>'
+        '<th align="left">Remote</th>'
+        '<th align="left">Type</th>'
+        '<th align="left">First Seen</th>'
+        '<th align="left">State</th>'
+        '<th align="left">City</th>'
+        '<th align="left">Region</th>'
+        '<th align="left">Country</th>'
+        '<th align="left">Lat &amp; Long</th>'
+        '<th align="left">Hostname</th>'
+        "</tr>")
+    _footer = "</table></body></html>"
+    _summary_head = '<table cellspacing="10"><tr valign="top">'
+    _summary_table = '<td><table><tr><th align="left">{}</th><th align="right">Connections</th></tr>{}</table></td>'
+    _summary_row = '<tr><td>{}</td><td align="right">{}</td></tr>'
+    _summary_footer = "</tr></table>"
+    _more = '<p id="more" class="mt">Showing the first {} of {} connections - <a href="#" onclick="return nlabs_more(\'{}\');">show all</a></p>'
+    _row = ('<tr><td><span style="color:#F5428A;">{}</span>:{}</td><td><span style="color:#F5428A;">{}</span>:{}</td>'
+        "<td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>")
+
+    # document heads keyed by the refresh interval, None when producing
+    # multiple reports
+    _heads = {}
+
+    # formatted timestamps keyed by the second
+    _times = {}
+
+    # rendered rows keyed by connection, each with the IP_AddressInfo and
+    # state it was rendered from and the row encoded for the data file once
+    # it has been needed
+    _rows = {}
+
     @staticmethod
-    def write(cl, il, mr = False):
+    def _head(refresh):
+        head = ReportWriter._heads.get(refresh)
+        if head == None:
+            head = "<html><head>"
+            if refresh != None:
+                head += '<meta http-equiv="refresh" content="'+str(refresh)+'; url=nlabs.studio_report.htm">'
+            head += "<title>NLabs.Studio Netmonitor Snapshot Report</title>" + ReportWriter._style + ReportWriter._script + "</head>" + ReportWriter._banner
+            ReportWriter._heads[refresh] = head
+        return head
 
-        date_t = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        filepath_t = 'nlabs.studio_report.htm' if not mr else date_t.replace(':', '_').replace('-', '_') + '_nlabs.studio_report.htm'
+    @staticmethod
+    def _time(t):
+        second = int(t)
+        dt = ReportWriter._times.get(second)
+        if dt == None:
 
-        f = open(filepath_t, 'w', encoding='utf-8')
-        f.write("<html>")
-        f.write("<head>")
-
-        if not mr:
-            f.write('<meta http-equiv="refresh" content="'+str(g_refresh_interval)+'; url=nlabs.studio_report.htm">')
-
-        f.write("<title>NLabs.Studio Netmonitor Snapshot Report</title>")
-        f.write('<style type="text/css">')
-        f.write("body{margin:0;padding:20px 0px 0px 20px;background-color:#000000;color:#ffffff;font-size:13px;}")
-        f.write("h1{font-size:20px;padding:0;margin:0;color:#ffffff;}")
-        f.write(".pl{padding-left:20px;}")
-        f.write("p{font-size:20px;margin:0px;padding:0px;}")
-        f.write("th{cursor:pointer;}")
-        f.write(".mt{margin-top:10px;}")
-        f.write("</style>")
-        f.write('<script type="text/javascript">')
-        f.write("var gcv = function(tr, idx){ return tr.children[idx].innerText || tr.children[idx].textContent; };var c = function(idx, asc) { return function(a, b) { return function(v1, v2) {return v1 !== '' && v2 !== '' && !isNaN(v1) && !isNaN(v2) ? v1 - v2 : v1.toString().localeCompare(v2);}(gcv(asc ? a : b, idx), gcv(asc ? b : a, idx));}};window.onload = function(){Array.prototype.slice.call(document.querySelectorAll('th')).forEach(function(th) { th.addEventListener('click', function() {var table = th.parentNode;while(table.tagName.toUpperCase() != 'TABLE') table = table.parentNode;Array.prototype.slice.call(table.querySelectorAll('tr:nth-child(n+2)')).sort(c(Array.prototype.slice.call(th.parentNode.children).indexOf(th), this.asc = !this.asc)).forEach(function(tr) { table.appendChild(tr) });})});};")
-        f.write("</script>")
-        f.write("</head>")
-        f.write("<body>")
-        f.write('<table id="data_table">')
-        f.write('<tr valign="top" cellspacing="10">')
-        f.write('<td><a href="https://www.nlabs.studio" target="_blank"><img src="data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAEYAAAA1CAYAAAD8mJ3rAAABhGlDQ1BJQ0MgcHJvZmlsZQAAKJF9kT1Iw1AUhU9TtaIVBzuoOGSoTnZREcdSxSJYKG2FVh1MXvoHTRqSFBdHwbXg4M9i1cHFWVcHV0EQ/AFxdnBSdJES70sKLWK84ZGP8+45vHcfIDQqTDW7ooCqWUYqHhOzuVUx8IoejMBHX7/ETD2RXszAs77uqY/qLsKzvPv+rAElbzLAJxJHmW5YxBvEs5uWznmfOMRKkkJ8Tjxp0AGJH7kuu/zGueiwwDNDRiY1TxwiFosdLHcwKxkq8QxxWFE1yheyLiuctzirlRprnZPfMJjXVtJcpzWGOJaQQBIiZNRQRgUWIvTXSDGRov2Yh3/U8SfJJZOrDEaOBVShQnL84G/we7ZmYXrKTQrGgO4X2/4YBwK7QLNu29/Htt08AfzPwJXW9lcbwNwn6fW2Fj4CBreBi+u2Ju8BlzvA8JMuGZIj+WkJhQLwfkbPlAOGboG+NXdurX2cPgAZmtXyDXBwCEwUKXvd4969nXP7t6c1vx8sBHKK8ql/LgAAAAZiS0dEAP8A/wD/oL2nkwAAAAlwSFlzAAAuIwAALiMBeKU/dgAAAAd0SU1FB+gGGQELERwUTfQAAAAZdEVYdENvbW1lbnQAQ3JlYXRlZCB3aXRoIEdJTVBXgQ4XAAAOSklEQVRo3u2be5TV1XXHP+feGcARBgQVUEEN4iP4ADVKCBFsHqVJVrtcNdGk0SY2taYlmqZpumpdNq1xNWmNIUlpUzVpU21iijWaNGlsfdwaWQ0GUWR4CCIzIILyEMS54DD39+0f93uYzY9BUPGRtThr3TXzu+ecffZvn72/e5999oUD2CRNlXSfpKclbZHUK6lT0uQDQPtESbeb3vOSevz3Yl6HVjnA9DqA7wBHAEOBKrAC2HgAaK8B7gC2A8OAVv//y7e8YFJKW4CHgEb4+okDIZiU0nZgEfBcViLgKaDzLS8YSQmYEOgWwAoL7EC0UdZGLPyHLKC3vCkl4NxAd/0B3tGxwDFBMA++XoJpCbvdDkwDjgMOAQYBOyR9M6UEMBGYbux4ArgrpfR8P4KZbGwBeBpY3Y9WtQLHAlOBt5mPjcDPgeXA+4CjgVtTSps8r9Vjh5jUVmABcJik84CzLKT7gHkppR2ldVuBkV7zFL9fw+s+CTyWUlrdnxmMkvR1Sc8a8V+S9KCkcZJukLROUt19dUn/IamtRGOEpNXqa3dIGh6FIul4SX8rab0913JJ80x/o6TF/v4xSePC3NGS/i3Q/i9JUyT9VNJmSdvN2xZJn5BUDXMPlfRZSV2Stkla4TWfkvSi5z74chgxXtJ/e+GGpNsk/bOk+yVdb2KF+zdKmlaa/x5Jm9zfK+nvSkI5yS8kM/NtScdJGiDpM4G27JpHhvmnS3ok9N8paa6F/9eSHg59SyUNC3Mvl7TB9B+VdKK/P0fSfM+Z3a8puR0KtAezONPq+smUUpekXpvUAOPI0NL8s4GB/n8zsCz0tQN/Bczwcw24PqXUWRRFSimV3e7jwLbwfCRwYnieBswCvppSqkvaApxh3o6x2S2QNNRjD7cz6EgpLbene1jSjwwdD7wc+I4ywOX2InBtSqkrvFxLAL91+xDM0tD3IX+wXd+RUnrKDCbHJrnttFC3e2cHACcAg8OYu4Gvp5Tqft4O9IT+TK/Nn13OQdL5Ydx3gcuNTXsKptFoJAtldHC1N2WvIukw70Se80LUCEkjApACbMr9RVG0AJ/wzuCgrxb4qNrN59YFrEspZY8z2JpKEPrskkYNCfQV+jYYXHstmHHA30v6nKThKaWulNLcsiPZJZhKpTLUaJ1bN3BvSqnw87HAmCC0xz0mtwnAYf6/F1iVUtpsjXi7d7xiTVueUlpZMul3mXHsmZ4tmXgUzANAVxacpIHe0GrQuC6v3Qt82659p3k4xWZ9k6S37yuOGQbEQYvsEnM7LphZA5hXiiFODZhTBx4rCe3QYJ4dJT6GA1PC85Mhws28RY2aazq5HQWMD9qy1Bodo+/LgH8JdAcDvw1cLWn0ywlmeGnx+dlmi6LIKhjN7BclWqcG4K4Dj4a+kY5dMhZ0lkz4IwETdgJPppRetDa0mK/BoX9RKU45wcCb239aa/NxQsbJTwMzS9h3AXB8vwGeff4xDqr2EExKaThwUuh7HlgSVHm4ibcErVgYxreGTeiNmlipVE4Dft/eBOAZYFVp7jnheT2wJWDbYAeeOSLuBO4CCknHOVicm1JaklJqSLrTJvuDCM6NRiNVq1WVNWYQMCksXgeW2T3j88nJoX9JCV9OsEfL2tSVUooHxy1hBzMeIOkM4DoDZRFefE1JMOeG5558SHUUfSbwO4Hvr1qwrcAH7UA+ahwipdQo0d8IbI1CiXHMIIfU0SY3VyoVhRgiArMCUFIyMwAVRVGtVCr5lP0La8lwA/TnJc2wFj5gwZwZXGp6GXw5Cjhb0nrz/Bd2DC8ANwLfSym9ZC3O7/RhYImk+z3/qrCJtwEr9xbxHu0wuS5ph6RbJB2RbVzSx/x93Z+NkuYURdHmMV9waF2X1O0o81t28Uiq2j1uDHRWS7rGof6DYf4WST+SdIqj5Q9I2ippiaQf+ijxjPld42TVA5IukDTYWoSkIx0dd5v2Wh8/VnlOl6RrvX7q7zSc3d3pwbTWAWttkxWD59jS3JwfwW68jOwvSFpRqVR6Q5B2itep2913SlJK6dQQGGbaK1NK3fYYZzn26fRapxno6wbSlUCPzSQeVg+xto83HLTaDJ+R1OHYpTfESwfbwXawHWwH25vZ0muZXJ8+PUfMg4E1bbXaC6+STsWR8yFAV1uttu1V0ml19D4EWNVWq734mgRTnz69xe6y3laraT8ZOBf4rM8oFacCbve90pb9pFN1Emmmg7ic+70duK2tVtuwnwIZYH6udARfCXS+A2x9Bfy0AD1ZMBMcDf4T8FhbrdbYy8Rk7bgC+Lyj0sKfFh/wfg78GbC0rVbb+TJ0DvOJ90rHSQ1H1C0+PtwLfBF4fB/8DAUuBa42zchPj/n5ArCsrVbr3QedP3LG8t4smNOdEet2nuKesllYq8YBfw5cCOwAFjuk3+IgbLIDsFUO1e/dC50TvRGXes0O50s2ecffbRNdBlwLPNAPnVanQq7x6TwHjf/rI8bEwM9Kj7u3bKbm5yTgj33m+hTw71kwR5mBi7xr3/IJtdNSH+ET7lUWwELgFuBf22q1eljkbC/wAX91EzDHVyg9jj7PtJZMNp1/BL6f8cB4M8lmmlOhs83P6sBPNuVJpnOzza+7xM/ngN+wRt4M3On32uk88DnWlMzPTGBeCkSGO/34h9aMDqtVt1OW7zQO3QXc0Farzd+LWrY7h/oHPnUvoXm/XPfzOx2a/xD4Wlut9vBe6IwwPzOtGYvMT938TXGq4k5gVlutNm8vdIZZCz7t91hsfrb7eaozf3cDNwAL2mq1IpWIDHJu4zPO5sdEVqcl/t22Wm3tfoDz+y3k95duI9ZYI29tq9XW7IPOQOC93tEZJS/aaUy8dT/4Gei8zEzTq4bu1ebntshP2gsQHQecB5xv17cIuMdA2P0KXfk002m39vwE6NhfV2p+jreGvMd0FhmcF0RT3g9+xpiX8/xeHcDP+uMn7cMFHmrpbt9fV74POjuA7ldJp9UeMfOzva1WK94sfg62g+0AHgnejObE2UCbQk6DFkA93IHl6ob8fo2YxNqf1vIruJnH2vVOMYC2OoF+Ec1bx3zl8nHnd1+iees5/43cvaqkdknDnG+tvAFrHirpUkkrXaVQOGdcCWNOkNTh/k2SPvRK13mtGvM2R5atNG8C5rD77eWBt/1mHngJfXdLvex5K3qGo1qsMY++YYKRNMjB2xX+agN9d0OvdzsmvHgve96KPu5gbiCwTdK61yQYZ9aTI95qALbCO1KklORxI4BLAnNLgO2+1SxMowzujXB7mUpjGv1l620iuz6SXmL3C74e4JfmK49bRbOiE6AI92N7oxvfs0gp9d2n+IUmGLR+zSmFPHG91XW2Q+iJPjZ8JKQblvl03O2D5CcNkC1ZqA7tF/slznKqYKT7vgTcl72H+RlN87Lstwy6hU11iIWDteW95uECr91OX03MjcA3w4a0GJQv9jFjrHnc4RP+bJ+nmtJzmVgGrHmSrnAt2z3+bqFLs851idjaUNrVKekul4d9wwB5lqRaGLNW0piwER91zZx8CTcpXJa1Snqf+djpy7HrJF3iSzcF4J2Vr19dA3hz6K9LmlGi+0FJj3vthZKulDTTJWiS9ISkczKTh0u6KRC8MKO8pHf4pX4gaWzwDB1h/I2+UIuqOso1fLnd7eKiPP8vQ9+SXIrh28d3uzgxe5WLAz8XunAyC+aiUiHidYHuc7HEw8JeGjZqaui7xnWHknR7dnFD7GFym8Tu1U9XWcVyMc8JPmjipNDylFJPyYyHOD2QWz7qw5730fOtytC8OfwUfWUdc4CfxOAt4FK3gbbwyw1n94qNxdl7STradE+2ac8xPOT2fODh/JawQFcYdDkwTNKslNIKmjX8EaCnBuBeS7MIoNwOY/dCpEfCwkNp1tNEwWw37ZONKZmvOf6b8WEUfbU2S4HNAbRHh80Q8H/0le9P9Ok8O4vb2b20fxB9pSiDs8ZsBL5vz4Jd4WXAHb7QT6XdelfIaayhWRpGKRw/ib5ColU078ILFyEdTl8FVK8zZy9ZS6fQV5n1CNAZtGVYPwKNBURHlQQzD2hIOsQaOMJ9S2iWqhQAjUajak3Nm72h4qCpAO63pvyMZuHPQJqX59cZ7XM7xOnNFqtwZ0qpnCjKY2JckevxBprJzMRyYIN3fRB95SB5XiwaPILda2XmZ/O0wMcEU+qmWXnV8AaND/MeDWZNpVIZGaBBwCOVEFEWKaW5dmNf9oskY88FRVFkDTkt7OgW+ioeKKllFMyiEKm2A78e+jpCXyt9lVE5u9YdtHBSwJ46sDRjW0ppaAm3HqOvTm8AfYWTOMaJNxhjw9wG8OOKq8EvkTTBC2wtiuJv7NOzDbanlDIYn0JfycY2moWESBricvh8RxXx5amU0ovu+81g67sBpDdiUOjb2mg08guMdxI9BXzZFMYO86b1h2kNmyphQxslgedSuoXA/1SAj/lS6rI8q1qtFoFQT36x4G2yplWAqqQjgT8BrrcdV9m9arzFFdq/5wT3mpLQ6gFvolmOq1arQyS9w9cfESxXsHudb1kwHUEwZc0eGd5hvIPaFpoVnV8BNrQED3OBpM0GponOjWZkvyUQXegF273Al63uQ2iWsG/zootpFgkB/Cnwu1b/f7AAd6UR/MuXbVb9n/r6JfneaYox6z4zPiWcl8ZIyuWpx4djQtbswyWtc0n9j50QP89wsU5S3f9PtoO43qFBD5K+6N8xrnJA9Jx/CTJP0tWSji0d6Qc6Kn7C0eOzkr7noGxgiDBnSFrgMU/7ly0nSzrTUeYif+ZKmuYURnLp1w0O7OqSHpL0YUljJc12YLnIP7iY5ZTHIP+QYnGJ7sdtvjlFMkHS15yy2Oggb4Gkr5ivXVVd/w/7ZuBOGA4Z0AAAAABJRU5ErkJggg==" alt="" /></a></td>')
-        f.write('<td class="pl"><h1>NLabs.Studio Snapshot Report</h1><p class="mt">Autonomous network monitoring reports for TCP/UDP connections active on the (NIC) network interface card.</p></td>')
-        f.write("</tr>")
-        f.write("</table>")
-        f.write("<br />")
-        f.write("<p>Report produced at "+ date_t +" with "+ str(len(cl)) +" connections and "+ str(len(il)) +" entries in cache</p>")
-        f.write('<table cellspacing="10">')
-        f.write("<tr>")
-        f.write('<th align="left">Local</th>')
-        f.write('<th align="left">Remote</th>')
-        f.write('<th align="left">Type</th>')
-        f.write('<th align="left">Time</th>')
-        f.write('<th align="left">State</th>')        
-        f.write('<th align="left">City</th>')
-        f.write('<th align="left">Region</th>')
-        f.write('<th align="left">Country</th>')
-        f.write('<th align="left">Lat &amp; Long</th>')
-        f.write('<th align="left">Hostname</th>')        
-        f.write("</tr>")
+            # connections come and go, keep the memo from growing unbounded
+            if len(ReportWriter._times) > 100000:
+                ReportWriter._times.clear()
+            dt = datetime.fromtimestamp(second).strftime('%Y-%m-%d %H:%M:%S')
+            ReportWriter._times[second] = dt
+        return dt
 
-        for key, c in cl.items():
+    @staticmethod
+    def _render(c, i):
+        if i == None:
+            i = IP_AddressInfo(c.remoteIP(), 'NA', '*', '*', '*', '*')
+        ctype = 'UDP/IP' if c.connectionType() == socket.SOCK_DGRAM else 'TCP/IP'
+
+        # the supplier data is escaped as it is not under our control
+        escape = html.escape
+        return ReportWriter._row.format(c.localIP(), c.localPort(), c.remoteIP(), c.remotePort(), ctype, ReportWriter._time(c.time()), c.status(),
+            escape(i.city()), escape(i.region()), escape(i.country()), escape(i.location()), escape(i.hostname()))
 
-            i = il[key]
+    @staticmethod
+    def _summary(summary):
+        escape = html.escape
+        tables = []
+        for title, rows in summary.tables():
+            body = ''.join(ReportWriter._summary_row.format(escape(str(key)), count) for key, count in rows)
+            tables.append(ReportWriter._summary_table.format(escape(title), body))
+        return ReportWriter._summary_head + ''.join(tables) + ReportWriter._summary_footer
 
-            f.write("<tr>")
-            f.write('<td><span style="color:#F5428A;">'+ c.localIP() +"</span>:"+ str(c.localPort()) +"</td>")
-            f.write('<td><span style="color:#F5428A;">'+ c.remoteIP() +"</span>:"+ str(c.remotePort()) +"</td>")
+    # forget the rendered rows of closed connections
+    @staticmethod
+    def discard(keys):
+        for key in keys:
+            ReportWriter._rows.pop(key, None)
 
-            ctype = 'TCP/IP'
-            if str(c.connectionType()) == 'SocketKind.SOCK_DGRAM':
-                ctype = 'UDP/IP'
-            f.write("<td>"+ ctype +"</td>")
+    # cl - dictionary of SocketConnection objects
+    # il - dictionary of IP_AddressInfo objects keyed by ip address
+    # mr - (optional) produce multiple document reports
+    # summary - (optional) the ReportSummary of cl, summarized when omitted
+    # row_limit - (optional) the number of connections listed in the report,
+    # defaults to g_report_rows
+    @staticmethod
+    def write(cl, il, mr = False, summary = None, row_limit = None):
+        started = time.perf_counter()
+        date_t = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        filepath_t = 'nlabs.studio_report.htm' if not mr else date_t.replace(':', '_').replace('-', '_') + '_nlabs.studio_report.htm'
+        datapath_t = filepath_t[:-len('.htm')] + '.js'
+        row_limit = g_report_rows if row_limit == None else row_limit
+        if summary == None:
+            summary = ReportSummary().update(cl, il)
+        infos = summary.infos
+
+        # the report lists the first row_limit connections, the full list is
+        # written to a data file the report loads on demand as browsers block
+        # fetch() on documents opened from disk
+        capped = row_limit > 0 and len(cl) > row_limit
+        shown = len(cl) if not capped else row_limit
 
-            dt = datetime.fromtimestamp(c.time())
-            f.write("<td>"+ dt.strftime('%Y-%m-%d %H:%M:%S') +"</td>")
+        buffer = io.StringIO()
+        buffer.write(ReportWriter._head(None if mr else g_refresh_interval))
+        buffer.write("<p>Report produced at "+ date_t +" with "+ str(len(cl)) +" connections to "+ str(len(infos)) +" remote addresses and "+ str(len(il)) +" entries in cache</p>")
+        buffer.write(ReportWriter._summary(summary))
+        if capped:
+            buffer.write(ReportWriter._more.format(shown, len(cl), datapath_t + '?' + str(int(time.time()))))
+        buffer.write(ReportWriter._table_head)
 
-            f.write("<td>"+ c.status() +"</td>")            
-            f.write("<td>"+ i.city() +"</td>")
-            f.write("<td>"+ i.region() +"</td>")
-            f.write("<td>"+ i.country() +"</td>")
-            f.write("<td>"+ i.location() +"</td>")
-            f.write("<td>"+ i.hostname() +"</td>")
-            f.write("</tr>")
+        rows = ReportWriter._rows
+        batch = []
+        data = [] if capped else None
+        n = 0
+        for key, c in cl.items():
+            i = infos.get(c.remoteIP())
 
-        f.write("</table>")
-        f.write("</body>")
-        f.write("</html>")
-        f.close()
+            # only new connections and those whose state or cache record has
+            # changed since the last report are rendered again
+            cached = rows.get(key)
+            if cached == None or cached[1] is not i or cached[2] != c.status():
+                cached = (ReportWriter._render(c, i), i, c.status(), None)
+                rows[key] = cached
+            if capped:
+                if cached[3] == None:
+                    cached = cached[:3] + (json.dumps(cached[0]),)
+                    rows[key] = cached
+                data.append(cached[3])
+            if n < shown:
+                batch.append(cached[0])
+                if len(batch) == ReportWriter._batch_size:
+                    buffer.write(''.join(batch))
+                    batch.clear()
+            n += 1
+        buffer.write(''.join(batch))
+        buffer.write(ReportWriter._footer)
+        if capped:
+            data = 'nlabs_rows([\n' + ',\n'.join(data) + ']);\n'
+        Metrics.observe('report_render', time.perf_counter() - started)
+
+        # the data file is in place before the report which loads it
+        written = 0
+        with Metrics.timer('report_write'):
+            if capped:
+                written += _write_atomic(datapath_t, data.encode('utf-8'))
+            elif not mr:
+                try:
+                    os.remove(datapath_t)
+                except FileNotFoundError:
+                    pass
+            written += _write_atomic(filepath_t, buffer.getvalue().encode('utf-8'))
+        Metrics.count('report_bytes_written', written)
 
 # socket connection
+#
+# connections are slotted and their addresses and states interned, sockets to
+# the same remote address share a single string
 class SocketConnection:
-    def __init__(self, local_ip, local_port, remote_ip, remote_port, conn_type, status):
-        self.local_ip = local_ip
+    __slots__ = ('local_ip', 'local_port', 'remote_ip', 'remote_port', 'conn_type', 'conn_status', 'conn_pid', 'log_time', 'last_seen', 'transitions')
+
+    # the number of past state transitions kept for each connection
+    _max_transitions = 8
+
+    def __init__(self, local_ip, local_port, remote_ip, remote_port, conn_type, status, pid = None, log_time = None):
+        self.local_ip = _intern(local_ip)
         self.local_port = int(local_port)
-        self.remote_ip = remote_ip
+        self.remote_ip = _intern(remote_ip)
         self.remote_port = int(remote_port)
         self.conn_type = conn_type
+        self.conn_status = _intern(status)
+        self.conn_pid = pid
+        self.log_time = time.time() if log_time == None else log_time
+        self.last_seen = self.log_time
+        self.transitions = None
+    # marks the connection as seen in the current sweep, returns True when its
+    # state has changed since the previous sweep
+    def update(self, status, now):
+        self.last_seen = now
+        if status == self.conn_status:
+            return False
+        if self.transitions == None:
+            self.transitions = []
+        status = _intern(status)
+        self.transitions.append((now, self.conn_status, status))
+        del self.transitions[:-SocketConnection._max_transitions]
         self.conn_status = status
-        self.log_time =time.time()
+        return True
     def __str__(self):
         return self.conn_status +' '+ self.local_ip + ':' + str(self.local_port) +' '+ self.remote_ip + ':' + str(self.remote_port) +'           '
     def connectionType(self):
@@ -209,8 +1835,564 @@ class SocketConnection:
         return self.remote_port
     def status(self):
         return self.conn_status
+    def pid(self):
+        return self.conn_pid
     def time(self):
         return self.log_time
+    def firstSeen(self):
+        return self.log_time
+    def lastSeen(self):
+        return self.last_seen
+    # list of (time, previous state, new state) tuples, oldest first
+    def stateTransitions(self):
+        return self.transitions if self.transitions != None else []
+
+# the psutil style address and connection records of the /proc/net collector
+ProcAddress = collections.namedtuple('ProcAddress', ['ip', 'port'])
+ProcConnection = collections.namedtuple('ProcConnection', ['fd', 'family', 'type', 'laddr', 'raddr', 'status', 'pid'])
+
+# /proc/net socket collector - streams the connected sockets straight from the
+# kernel's tcp and udp tables (linux only)
+#
+# psutil.net_connections() walks the fd table of every process and returns
+# every socket, listeners included, before the sweep throws most of them
+# away. the collector reads each table in large buffered chunks and only
+# yields the entries with a remote address, the process ids are optional
+class ProcNetCollector:
+
+    # the tables read and the (family, type) of their sockets
+    _tables = (
+        ('tcp', socket.AF_INET, socket.SOCK_STREAM), ('tcp6', socket.AF_INET6, socket.SOCK_STREAM),
+        ('udp', socket.AF_INET, socket.SOCK_DGRAM), ('udp6', socket.AF_INET6, socket.SOCK_DGRAM))
+
+    # the tcp states of include/net/tcp_states.h named as psutil does, udp
+    # sockets have no state
+    _states = {
+        b'01': 'ESTABLISHED', b'02': 'SYN_SENT', b'03': 'SYN_RECV', b'04': 'FIN_WAIT1', b'05': 'FIN_WAIT2',
+        b'06': 'TIME_WAIT', b'07': 'CLOSE', b'08': 'CLOSE_WAIT', b'09': 'LAST_ACK', b'0A': 'LISTEN',
+        b'0B': 'CLOSING', b'0C': 'SYN_RECV'}
+    _no_state = 'NONE'
+    _buffer_size = 1 << 20
+
+    # root - (optional) the mount point of procfs
+    # pids - (optional) attribute each socket to the process holding it, this
+    # reads the fd table of every process and is as slow as psutil
+    # memo_size - (optional) the number of recent addresses memoized
+    def __init__(self, root = '/proc', pids = False, memo_size = g_classifier_memo_size):
+        self._root = root
+        self._pids = pids
+        self._address = functools.lru_cache(maxsize=memo_size)(ProcNetCollector._decode)
+
+    # returns True if the socket tables can be read under root
+    @staticmethod
+    def available(root = '/proc'):
+        return os.path.isfile(os.path.join(root, 'net', 'tcp'))
+
+    # the kernel prints each 32 bit word of an address in host byte order
+    @staticmethod
+    def _decode(value):
+        if len(value) == 8:
+            return socket.inet_ntop(socket.AF_INET, int(value, 16).to_bytes(4, sys.byteorder))
+        packed = b''.join(int(value[i:i + 8], 16).to_bytes(4, sys.byteorder) for i in range(0, 32, 8))
+        return socket.inet_ntop(socket.AF_INET6, packed)
+
+    # returns the dictionary of socket inode to the (pid, fd) holding it
+    def _inodes(self):
+        inodes = {}
+        try:
+            procs = [e.name for e in os.scandir(self._root) if e.name.isdigit()]
+        except OSError:
+            return inodes
+        for pid in procs:
+            fd_path = os.path.join(self._root, pid, 'fd')
+            try:
+                fds = os.listdir(fd_path)
+            except OSError:
+
+                # the process has gone or belongs to another user
+                continue
+            for fd in fds:
+                try:
+                    link = os.readlink(os.path.join(fd_path, fd))
+                except OSError:
+                    continue
+                if link.startswith('socket:['):
+                    inodes.setdefault(link[8:-1].encode(), (int(pid), int(fd)))
+        return inodes
+
+    def __call__(self):
+        return self.connections()
+
+    # generator of the ProcConnection records of the sockets with a remote
+    # address, in the same form as psutil.net_connections()
+    def connections(self):
+        inodes = self._inodes() if self._pids else None
+        address = self._address
+        states = ProcNetCollector._states
+        split = 10 if inodes != None else 4
+        for name, family, type_ in ProcNetCollector._tables:
+            try:
+                f = open(os.path.join(self._root, 'net', name), 'rb', buffering=ProcNetCollector._buffer_size)
+            except FileNotFoundError:
+
+                # ipv6 is disabled
+                continue
+            with f:
+                f.readline()
+                for line in f:
+                    fields = line.split(None, split)
+
+                    # listeners and unconnected udp sockets have no remote port
+                    remote = fields[2]
+                    if remote.endswith(b':0000'):
+                        continue
+                    local = fields[1]
+                    rip, _, rport = remote.partition(b':')
+                    lip, _, lport = local.partition(b':')
+                    status = states.get(fields[3], ProcNetCollector._no_state) if type_ == socket.SOCK_STREAM else ProcNetCollector._no_state
+                    pid, fd = None, -1
+                    if inodes != None:
+                        pid, fd = inodes.get(fields[9], (None, -1))
+                    yield ProcConnection(fd, family, type_, ProcAddress(address(lip), int(lport, 16)), ProcAddress(address(rip), int(rport, 16)), status, pid)
+
+# connection table - tracks the connections across cycles keyed by protocol,
+# local and remote address and port and the owning pid when available
+class ConnectionTable:
+    def __init__(self):
+        self._connections = {}
+        self._closed = {}
+    def __len__(self):
+        return len(self._connections)
+    # dictionary of connection key to SocketConnection
+    def connections(self):
+        return self._connections
+    # dictionary of connection key to SocketConnection of the connections
+    # closed by the last update
+    def closed(self):
+        return self._closed
+    # live - iterable of psutil style connections that have a remote address
+    # now - (optional) the time of the sweep
+    #
+    # returns the (added, removed, changed) lists of connection keys, changed
+    # connections are those whose state differs from the previous sweep
+    def update(self, live, now = None):
+        now = time.time() if now == None else now
+        connections = self._connections
+        added = []
+        changed = []
+        for c in live:
+            key = (c.type, c.laddr.ip, c.laddr.port, c.raddr.ip, c.raddr.port, c.pid)
+            conn = connections.get(key)
+            if conn == None:
+                connections[key] = SocketConnection(c.laddr.ip, c.laddr.port, c.raddr.ip, c.raddr.port, c.type, c.status, c.pid, now)
+                added.append(key)
+            elif conn.update(c.status, now):
+                changed.append(key)
+
+        # anything not seen by this sweep has been closed
+        removed = [key for key, conn in connections.items() if conn.last_seen != now]
+        self._closed = {key: connections.pop(key) for key in removed}
+        return added, removed, changed
+
+# snapshot pipeline - the stages of a cycle, the connection sweep, resolution
+# of the new remote addresses, cache persistence and the report
+class SnapshotPipeline:
+    # info_list - the CacheStore of IP_AddressInfo records
+    # resolver - the AddressResolver for the lookups
+    # neg_cache - the NegativeCache of failed lookups
+    # mr - (optional) produce multiple document reports
+    # collector - (optional) the callable returning the live connections,
+    # defaults to psutil.net_connections
+    # history - (optional) the HistoryStore recording the connections
+    # metrics_path - (optional) the json file the Metrics are written to after
+    # each report
+    def __init__(self, info_list, resolver, neg_cache, mr = False, collector = None, history = None, metrics_path = None):
+        self.info_list = info_list
+        self.resolver = resolver
+        self.neg_cache = neg_cache
+        self.mr = mr
+        self.collector = psutil.net_connections if collector == None else collector
+        self.history = history
+        self.metrics_path = metrics_path
+
+        # the connections and records yet to be recorded in the history, the
+        # daemon records them from the persistence stage
+        self._unrecorded = []
+        self._closed = []
+        self._resolved = []
+        self._history_lock = threading.Lock()
+
+        # the connections are tracked across cycles, retry holds the remote
+        # addresses whose lookup is yet to complete
+        self.conn_table = ConnectionTable()
+        self.summary = ReportSummary()
+        self._retry = set()
+        self._last_scan = 0
+    # returns the live connections with an external remote address
+    def collect(self):
+
+        # skip if a remote host has not been ACKnowledged or the remote
+        # connection is indeed internal on the LAN or a NAT proxy
+        with Metrics.timer('collect'):
+            return NetworkUtils.classifier.external_connections(self.collector())
+    # sweep the live connections, returns the (added, removed, changed) lists
+    # of connection keys
+    # external - (optional) the result of collect(), collected when omitted
+    def sweep(self, external = None, now = None):
+        if external == None:
+            external = self.collect()
+        with Metrics.timer('sweep'):
+            added, removed, changed = self.conn_table.update(external, now)
+        Metrics.gauge('connections', len(self.conn_table))
+        Metrics.count('connections_added', len(added))
+        Metrics.count('connections_removed', len(removed))
+        if self.history != None and (added or removed):
+            connections = self.conn_table.connections()
+            with self._history_lock:
+                self._unrecorded.extend(connections[key] for key in added)
+                self._closed.extend(self.conn_table.closed().values())
+        return added, removed, changed
+    # returns the dictionary of remote ip to requery flag of the lookups due
+    # after a sweep which added the given connection keys
+    def pending(self, added):
+
+        # only the remote addresses of new connections and those which are
+        # yet to resolve need a lookup, the remaining live addresses are
+        # checked periodically for records due a requery, addresses to retry
+        # whose connections have since closed are dropped
+        now = time.time()
+        live = {key[3] for key in self.conn_table.connections()}
+        candidates = self._retry & live
+        self._retry = set()
+        candidates.update(key[3] for key in added)
+        if now - self._last_scan > g_requery_scan_interval:
+            candidates.update(live)
+            self._last_scan = now
+
+        # foreach candidate - the snapshot is collected in full before any
+        # lookups take place, the lookups are queued up in pending by ip
+        pending = {}
+        hits = misses = requeries = 0
+        for remote_ip in candidates:
+
+            # check for quit flag
+            if g_quit_flag:
+                break
+
+            # failed lookups are retried once the negative cache expires
+            if remote_ip in self.neg_cache:
+                self._retry.add(remote_ip)
+                continue
+
+            # determine if a requery is necessary to update the cache record
+            info = self.info_list.get(remote_ip)
+            requery = False
+            if info != None:
+                requery = not info.isResolved() or info.logTime() < (now - (g_requery_in_days * 86400))
+
+            # no cache record exists or its time for a requery
+            if info == None or requery:
+                pending[remote_ip] = requery
+            if info == None:
+                misses += 1
+            elif requery:
+                requeries += 1
+            else:
+                hits += 1
+        Metrics.count('cache_hits', hits)
+        Metrics.count('cache_misses', misses)
+        Metrics.count('cache_requeries', requeries)
+        return pending
+    # cache the results of the pending lookups
+    def apply(self, pending, results):
+        for remote_ip, requery in pending.items():
+
+            # the lookup is still in flight, leave the cache untouched
+            if remote_ip not in results:
+                self._retry.add(remote_ip)
+                Metrics.count('lookups', outcome='timeout')
+                continue
+            data_t, hostname = results[remote_ip]
+
+            # the supplier failed or rate limited us, hold off until the
+            # negative cache entry expires
+            if data_t == None:
+                self.neg_cache.add(remote_ip)
+                self._retry.add(remote_ip)
+            Metrics.count('lookups', outcome='failed' if data_t == None else 'unlisted' if data_t is GeolocationClient.unlisted else 'resolved')
+
+            # if the third party supplier failed but we have a past 
+            # record then we skip overwritting the cached entry
+            fallback_on_past_record = data_t == None and requery
+            if fallback_on_past_record:
+                continue
+
+            # third party fetch failed... init some defaults, otherwise copy
+            # the result as it may be shared with other connections
+            if data_t == None:
+                data_t = {}
+                data_t['city'] = data_t['region'] = data_t['country'] = '*'
+            else:
+                data_t = dict(data_t)
+
+            # check hostname is available from third party, if not use the local resolver result
+            if 'hostname' not in data_t:
+                data_t['hostname'] = hostname if hostname != None else 'NA'
+
+            # if longitude/latitude are not available, flag as '*'
+            if 'loc' not in data_t:
+                data_t['loc'] = '*'
+
+            # cache the geolocation data record, keyed by the remote ip
+            info = IP_AddressInfo(remote_ip, data_t['hostname'], data_t.get('city', '*'), data_t.get('region', '*'), data_t.get('country', '*'), data_t['loc'], asn=data_t.get('org', ''))
+            self.info_list.put(remote_ip, info)
+            if self.history != None:
+                with self._history_lock:
+                    self._resolved.append(info)
+
+            # some console noise - basic response
+            print('-> '+ str(info), end='\r')
+    # retry the lookups of the given remote addresses after the next sweep
+    def retry(self, ips):
+        self._retry.update(ips)
+    # resolve the remote addresses of a sweep, blocking until the lookups have
+    # completed or their deadline has passed
+    def resolve(self, added):
+        with Metrics.timer('resolve'):
+            pending = self.pending(added)
+            self.apply(pending, self.resolver.resolve(pending.keys()))
+    # write the new and changed cache records to disk, along with the history
+    # of the connections seen since the last call
+    def persist(self):
+        with Metrics.timer('persist'):
+            written = self.info_list.flush()
+            Metrics.count('cache_rows_written', written)
+            Metrics.count('history_bytes_written', self.record())
+        Metrics.gauge('cache_entries', len(self.info_list))
+        Metrics.gauge('negative_cache_entries', len(self.neg_cache))
+        return written
+    # append the connections seen or closed and the records resolved since the
+    # last call to the history
+    def record(self):
+        if self.history == None:
+            return 0
+        with self._history_lock:
+            conns, self._unrecorded = self._unrecorded, []
+            closed, self._closed = self._closed, []
+            infos, self._resolved = self._resolved, []
+
+        # a new segment starts with the connections still open, the table is
+        # copied in one step as the sampler may be updating it
+        now = time.time()
+        live = list(self.conn_table.connections().values()) if self.history.starts_segment(now) else []
+
+        # addresses resolved by earlier cycles are taken from the cache
+        infos.extend(self.info_list.get(c.remoteIP()) for c in itertools.chain(conns, closed, live))
+        return self.history.append(now, conns, infos, closed, live)
+    # produce a readable report on the connections, summarized by the
+    # aggregation stage
+    # connections - (optional) the dictionary of SocketConnection objects,
+    # defaults to the live connection table
+    # removed - (optional) the keys of connections closed since the last report
+    def report(self, connections = None, removed = ()):
+        connections = self.conn_table.connections() if connections == None else connections
+        ReportWriter.discard(removed)
+        with Metrics.timer('report'):
+            with Metrics.timer('report_summary'):
+                summary = self.summary.update(connections, self.info_list)
+            ReportWriter.write(connections, self.info_list, self.mr, summary)
+        if self.metrics_path != None:
+            Metrics.write(self.metrics_path)
+    def close(self):
+
+        # the connections still open are recorded as closed when last seen,
+        # rather than held open past the end of the run
+        try:
+            if self.history != None:
+                with self._history_lock:
+                    self._closed.extend(self.conn_table.connections().values())
+                self.record()
+        finally:
+            self.resolver.shutdown()
+            self.info_list.close()
+
+# the changes of one or more sweeps passed between the daemon stages
+class SweepDelta:
+    __slots__ = ('time', 'added', 'removed', 'changed')
+    def __init__(self, time, added, removed, changed):
+        self.time = time
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+    # fold a later delta into this one
+    def merge(self, other):
+        self.time = other.time
+        self.added = self.added + other.added
+        self.removed = self.removed + other.removed
+        self.changed = self.changed + other.changed
+        return self
+
+# asyncio daemon - samples the connections on a fixed cadence while the
+# resolution, persistence and report stages run as separate tasks connected
+# by bounded queues
+#
+# a stage which falls behind never holds up the stage before it, the deltas
+# it has yet to accept are merged and offered again on the next sweep
+class SnapshotDaemon:
+    # pipeline - the SnapshotPipeline
+    # interval - the number of seconds between sweeps
+    # queue_size - (optional) the number of deltas buffered between stages
+    def __init__(self, pipeline, interval, queue_size = g_queue_size):
+        self._pipeline = pipeline
+        self._interval = interval
+        self._queue_size = queue_size
+        self._carry = {}
+        self._jitter = 0.0
+        self._stop = None
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self._stop.set)
+            except (NotImplementedError, RuntimeError):
+                signal.signal(sig, lambda *_: loop.call_soon_threadsafe(self._stop.set))
+
+        resolve_queue = asyncio.Queue(self._queue_size)
+        persist_queue = asyncio.Queue(self._queue_size)
+        report_queue = asyncio.Queue(self._queue_size)
+        tasks = [
+            asyncio.create_task(self._sample(resolve_queue, report_queue)),
+            asyncio.create_task(self._resolve(resolve_queue, persist_queue, report_queue)),
+            asyncio.create_task(self._persist(persist_queue)),
+            asyncio.create_task(self._report(report_queue))]
+        for task in tasks:
+            task.add_done_callback(self._stopped)
+        try:
+            await self._stop.wait()
+        finally:
+            print('\nstopping...')
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+            # the final persistence runs once the stages have stopped
+            await asyncio.to_thread(self._pipeline.persist)
+    def stop(self):
+        if self._stop != None:
+            self._stop.set()
+    # each stage logs an error and carries on with the next delta, a stage
+    # which ends regardless stops the daemon rather than leaving it hung
+    def _stopped(self, task):
+        if task.cancelled() or task.exception() == None:
+            return
+        print('\na daemon stage has stopped: '+ SnapshotDaemon._describe(task.exception()))
+        self._stop.set()
+    @staticmethod
+    def _describe(e):
+        return type(e).__name__ + ': ' + str(e)
+    def _failed(self, stage, e):
+        Metrics.count('stage_errors', stage=stage)
+        print('\nthe '+ stage +' stage failed and carries on with the next sweep: '+ SnapshotDaemon._describe(e))
+    # offer a delta to the next stage without waiting, a full queue leaves
+    # the delta to be merged with the next one
+    def _offer(self, queue, delta):
+        carry = self._carry.pop(queue, None)
+        if carry != None:
+            delta = carry.merge(delta)
+        try:
+            queue.put_nowait(delta)
+        except asyncio.QueueFull:
+            self._carry[queue] = delta
+    async def _sample(self, resolve_queue, report_queue):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        while not g_quit_flag:
+
+            # the sweep is scheduled against absolute deadlines so the time a
+            # sweep takes never accumulates into the cadence
+            started = loop.time()
+            self._jitter = max(self._jitter, started - deadline)
+            try:
+                external = await asyncio.to_thread(self._pipeline.collect)
+                now = time.time()
+                added, removed, changed = self._pipeline.sweep(external, now)
+
+                # the report is produced straight away, new connections show as
+                # unresolved until their lookups complete
+                self._offer(resolve_queue, SweepDelta(now, added, [], []))
+                self._offer(report_queue, SweepDelta(now, added, removed, changed))
+            except Exception as e:
+                self._failed('sample', e)
+
+            deadline += self._interval
+            if deadline < loop.time():
+
+                # the sweep overran its slot, skip to the next one
+                deadline += (loop.time() - deadline) // self._interval * self._interval + self._interval
+            await asyncio.sleep(deadline - loop.time())
+        self._stop.set()
+    async def _resolve(self, resolve_queue, persist_queue, report_queue):
+        loop = asyncio.get_running_loop()
+        resolver = self._pipeline.resolver
+        while True:
+            delta = await resolve_queue.get()
+            pending = {}
+            waiting = {}
+            try:
+                pending = self._pipeline.pending(delta.added)
+                if not pending:
+
+                    # the sweep still needs recording in the history
+                    self._offer(persist_queue, delta)
+                    continue
+
+                # the results are cached as the lookups complete, each batch is
+                # persisted and rendered
+                started = loop.time()
+                waiting = {asyncio.wrap_future(future): ip for ip, future in resolver.submit_many(pending).items()}
+                deadline = started + resolver.deadline(len(waiting))
+                while waiting and loop.time() < deadline:
+                    done, _ = await asyncio.wait(waiting, timeout=min(1.0, deadline - loop.time()))
+                    if not done:
+                        continue
+                    results = {}
+                    for future in done:
+                        results[waiting.pop(future)] = AddressResolver.result(future)
+                    self._pipeline.apply({ip: pending[ip] for ip in results}, results)
+                    self._offer(persist_queue, delta)
+                    self._offer(report_queue, SweepDelta(delta.time, [], [], []))
+
+                # lookups outside of the deadline are retried by a later sweep
+                if waiting:
+                    self._pipeline.apply({ip: pending[ip] for ip in waiting.values()}, {})
+                Metrics.observe('resolve', loop.time() - started)
+            except Exception as e:
+                self._failed('resolve', e)
+
+                # the addresses yet to be cached are retried by a later sweep
+                self._pipeline.retry(waiting.values() if waiting else pending)
+    async def _persist(self, persist_queue):
+        while True:
+            await persist_queue.get()
+            try:
+                await asyncio.to_thread(self._pipeline.persist)
+            except Exception as e:
+                self._failed('persist', e)
+    async def _report(self, report_queue):
+        while True:
+            delta = await report_queue.get()
+
+            # the report is rendered from a copy as the sampler keeps updating
+            # the connection table
+            connections = dict(self._pipeline.conn_table.connections())
+            try:
+                await asyncio.to_thread(self._pipeline.report, connections, delta.removed)
+            except Exception as e:
+                self._failed('report', e)
+                continue
+            jitter, self._jitter = self._jitter, 0.0
+            print('report produced with '+ str(len(connections)) +' connections (+'+ str(len(delta.added)) +' -'+ str(len(delta.removed)) +' ~'+ str(len(delta.changed)) +') and '+ str(len(self._pipeline.info_list)) +' cached entries, sampling jitter '+ f'{jitter*1000:.1f}' +'ms')
 
 def main():
 
@@ -222,19 +2404,59 @@ def main():
     parser.add_argument('-mr', type=str, required=False, help='flag to produce multiple html report documents')
     parser.add_argument('-r', type=int, required=False, default=10, help='override the default refresh rate between cycles')
     parser.add_argument('-sp', type=str, help='perform a single connection sweep and terminate once complete')
+    parser.add_argument('-w', type=int, required=False, default=g_resolver_workers, help='the number of concurrent geolocation and reverse dns lookups')
+    parser.add_argument('-to', type=float, required=False, default=g_request_timeout, help='the timeout in seconds of each geolocation and reverse dns request')
+    parser.add_argument('-cs', type=int, required=False, default=g_cache_max_entries, help='the maximum number of ip address information records held in the cache')
+    parser.add_argument('-al', type=str, required=False, help='networks always reported as external - comma separated CIDRs or a file with one per line')
+    parser.add_argument('-dl', type=str, required=False, help='networks excluded from reports such as your own public ranges - comma separated CIDRs or a file with one per line')
+    parser.add_argument('-d', type=str, required=False, help='flag to run as a daemon sampling on a fixed cadence with resolution and reporting in the background')
+    parser.add_argument('-ri', type=int, required=False, default=g_ipinfo_rate, help='the number of ipinfo.io requests allowed per minute')
+    parser.add_argument('-ra', type=int, required=False, default=g_ipapi_rate, help='the number of ip-api.com requests allowed per minute')
+    parser.add_argument('-db', type=str, required=False, help='offline geolocation dataset - a CSV of ip ranges or a MaxMind .mmdb database')
+    parser.add_argument('-rf', type=str, required=False, help='flag to fall back on the remote suppliers for addresses missing from the -db dataset')
+    parser.add_argument('-nt', type=int, required=False, default=g_negative_ttl, help='the number of seconds before a failed or rate limited lookup is retried')
+    parser.add_argument('-pc', type=str, required=False, help='flag to read the connections from the /proc/net socket tables rather than psutil - linux only')
+    parser.add_argument('-pp', type=str, required=False, help='flag to attribute the connections read from /proc/net to their process ids')
+    parser.add_argument('-rl', type=int, required=False, help='the number of connections listed in the report (default 1000), the full list is loaded on demand - 0 lists every connection')
+    parser.add_argument('-hs', type=str, required=False, help='flag to record when each connection is first seen and closed in the history directory')
+    parser.add_argument('-hd', type=int, required=False, default=g_history_days, help='the number of days of connection history kept')
+    parser.add_argument('-mf', type=str, required=False, help='write the per stage timings and counters to a json metrics file after each report')
+    parser.add_argument('-mp', type=int, required=False, help='serve the metrics in the prometheus text format on a local port')
+    parser.add_argument('-pf', type=str, required=False, help='profile the run with cProfile and dump the stats to a file on exit')
+
+    # query the connection history recorded with -hs
+    commands = parser.add_subparsers(dest='command')
+    query = commands.add_parser('query', help='query the connection history recorded with -hs')
+    queries = query.add_subparsers(dest='query', required=True)
+    first_seen = queries.add_parser('first-seen', help='when the first connection to an ip address or hostname was seen')
+    first_seen.add_argument('target', help='the remote ip address or hostname')
+    counts = {
+        'count': 'the number of connections open at any time over the last hours',
+        'count-new': 'the number of new connections, first seen over the last hours'}
+    for name, text in counts.items():
+        count = queries.add_parser(name, help=text)
+        count.add_argument('-hours', type=float, default=24, help='the number of hours counted back from now')
+        count.add_argument('-by', choices=['country', 'asn', 'host', 'remote_port', 'state'], help='group the connections by a column')
+        count.add_argument('-country', help='only count connections to a country')
+        count.add_argument('-asn', help='only count connections to an autonomous system')
+        count.add_argument('-host', help='only count connections to a remote hostname or ip address')
+        count.add_argument('-port', type=int, help='only count connections to a remote port')
+        count.add_argument('-state', help='only count connections in a state, the last recorded by count and the first seen by count-new')
     args = parser.parse_args()
 
+    if args.command == 'query':
+        _query(HistoryStore(retention_days=args.hd), args)
+        return
+
     # perform a flush on the IP_AddressInfo cache
     if args.x:
-        if os.path.isfile('info_cache'):
+        if os.path.isfile('info_cache.db') or os.path.isfile('info_cache'):
             try:
-                cache_data = {}
-                with open('info_cache', 'rb') as data_t:
-                    cache_data = pickle.load(data_t)
+                cache_data = CacheStore(max_entries=args.cs)
                 with open('ip_address_info', 'w') as f:
-                    for key, c in cache_data.items():
+                    for c in cache_data.values():
                         f.write(str(c) +"\n")
-                os.remove('info_cache')
+                cache_data.destroy()
                 print('OK -> flush successful')
             except:
                 print('processing error occurred')
@@ -242,6 +2464,13 @@ def main():
             print('cache data file does not exist')
         return
 
+    # classify remote addresses against the allow and deny lists
+    try:
+        NetworkUtils.classifier = IPClassifier(IPClassifier.networks(args.al), IPClassifier.networks(args.dl))
+    except ValueError as e:
+        print('invalid network in the allow or deny list: '+ str(e))
+        return
+
     # multiple report flag
     mr = args.mr and args.mr.lower() == 'true'
 
@@ -252,109 +2481,161 @@ def main():
     global g_refresh_interval
     g_refresh_interval = 10 if not args.r else args.r
 
-    print("NLabs.Studio Netmonitor Snapshot Report Writer")
-    print("CTRL+Q will terminate the process and return you to the command line prompt\n")
-    time.sleep(5)
-
-    while not g_quit_flag:
-
-        live_list = psutil.net_connections()
-        conn_list = {}
-
-        # info list accomodates our geolocation cache data, if we have actively
-        # ran our script before, we may have cache data available which reduces
-        # the load on our third party suppliers 
-        # 
-        # each record is stored for g_requery_in_days before forced update
-        info_list = {}
-        if os.path.isfile('info_cache'):
-            try:
-                with open('info_cache', 'rb') as data_t:
-                    info_list = pickle.load(data_t)
-            except:
-                info_list = {}
-
-        # foreach connection
-        for c in live_list:
+    # cap the connections listed in the report
+    global g_report_rows
+    if args.rl != None:
+        g_report_rows = max(0, args.rl)
 
-            # check for quit flag
-            if g_quit_flag:
-                break
-
-            # skip if a remote host has not been ACKnowledged
-            if not c.raddr:
-                continue
-            raddr = f"{c.raddr.ip}:{c.raddr.port}"
+    # resolver stage for the geolocation and reverse dns lookups
+    # offline geolocation from a local dataset, the suppliers are only queried
+    # for the addresses it misses when -rf is flagged
+    database = None
+    if args.db:
+        try:
+            database = GeoDatabase(args.db)
+        except (OSError, ValueError) as e:
+            print('the geolocation dataset could not be loaded: '+ str(e))
+            return
+    remote = database == None or (args.rf and args.rf.lower() == 'true')
+    client = GeolocationClient('' if not args.t else args.t, not nc, args.to, args.ri, args.ra, pool_size=args.w, database=database, remote=remote)
+    resolver = AddressResolver(client, args.w, args.to)
 
-            # skip if remote connection is indeed internal on the LAN or a NAT proxy
-            if NetworkUtils.is_internal(c.raddr.ip):
-                continue
+    print("NLabs.Studio Netmonitor Snapshot Report Writer")
+    if _register_hotkey():
+        print("CTRL+Q will terminate the process and return you to the command line prompt\n")
+    else:
+        print("CTRL+C will terminate the process and return you to the command line prompt\n")
+    if not args.d:
+        time.sleep(5)
 
-            # record connection
-            conn_list[raddr] = SocketConnection(c.laddr.ip, c.laddr.port, c.raddr.ip, c.raddr.port, c.type, c.status)
+    # info list accomodates our geolocation cache data, if we have actively
+    # ran our script before, we may have cache data available which reduces
+    # the load on our third party suppliers 
+    # 
+    # the cache is loaded once and kept in memory between cycles, each record
+    # is stored for g_requery_in_days before forced update
+    with Metrics.timer('cache_load'):
+        info_list = CacheStore(max_entries=args.cs)
 
-            # determine if a requery is necessary to update the cache record
-            requery = False
-            if raddr in info_list:
-                requery = info_list[raddr].logTime() < (time.time() - (g_requery_in_days * 86400))
+    # failed lookups are held in the negative cache for -nt seconds
+    neg_cache = NegativeCache(args.nt)
 
-            # no cache record exists or its time for a requery
-            if raddr not in info_list or requery:
+    # the /proc/net collector streams the connected sockets, psutil remains
+    # the default and the fallback on other platforms
+    collector = None
+    if args.pc and args.pc.lower() == 'true':
+        if ProcNetCollector.available():
+            collector = ProcNetCollector(pids=args.pp and args.pp.lower() == 'true')
+        else:
+            print('/proc/net is not available, falling back on psutil')
 
-                # fetch geolocation data
-                data_t = NetworkUtils.get_geolocation(c.raddr.ip, '' if not args.t else args.t, not nc)
+    # the connections of each sweep are recorded in a compressed segment per
+    # day, the segments past -hd days are deleted at startup
+    history = None
+    if args.hs and args.hs.lower() == 'true':
+        history = HistoryStore(retention_days=args.hd)
+        history.maintain()
 
-                # if the third party supplier failed but we have a past 
-                # record then we skip overwritting the cached entry
-                fallback_on_past_record = data_t == None and requery
-                if not fallback_on_past_record:
+    pipeline = SnapshotPipeline(info_list, resolver, neg_cache, mr, collector, history, args.mf)
 
-                    # third party fetch failed... init some defaults
-                    if data_t == None:
-                        data_t = {}
-                        data_t['ip'] = conn_list[raddr].remoteIP()
-                        data_t['city'] = data_t['region'] = data_t['country'] = '*'
+    # the metrics are served from a background thread
+    server = None
+    if args.mp:
+        try:
+            server = Metrics.serve(args.mp)
+            print('metrics served on http://127.0.0.1:'+ str(args.mp) +'/metrics')
+        except OSError as e:
+            print('the metrics endpoint could not be started: '+ str(e))
 
-                    # check hostname is available from third party, if not attempt to query it using a local socket
-                    if 'hostname' not in data_t:
-                        data_t['hostname'] = NetworkUtils.reverse_dns(c.raddr.ip)
-                        if data_t['hostname'] == None:
-                            data_t['hostname'] = 'NA'
+    # the stats of the main thread are dumped on exit, in daemon mode the
+    # stages run in worker threads and only the event loop is profiled
+    profiler = None
+    if args.pf:
+        profiler = cProfile.Profile()
+        profiler.enable()
 
-                    # if longitude/latitude are not available, flag as '*'
-                    if 'loc' not in data_t:
-                        data_t['loc'] = '*'
+    try:
 
-                    # cache the geolocation data record
-                    info_list[raddr] = IP_AddressInfo(data_t['ip'], data_t['hostname'], data_t['city'], data_t['region'], data_t['country'], data_t['loc'])
+        # daemon mode - sample on a fixed cadence with the remaining stages
+        # running alongside
+        if args.d and args.d.lower() == 'true':
+            asyncio.run(SnapshotDaemon(pipeline, args.m*60 if args.m else g_refresh_interval).run())
+            return
 
-            # some console noise - basic response
-            print('-> '+ str(conn_list[raddr]), end='\r')
+        while not g_quit_flag:
 
-        # serialise the cache data to disk
-        with open('info_cache', 'wb') as data_t:
-            pickle.dump(info_list, data_t)        
+            added, removed, changed = pipeline.sweep()
+            pipeline.resolve(added)
+            pipeline.persist()
+            pipeline.report(removed=removed)
+            print('report produced with '+ str(len(pipeline.conn_table)) +' connections (+'+ str(len(added)) +' -'+ str(len(removed)) +' ~'+ str(len(changed)) +') and '+ str(len(info_list)) +' cached entries')
+            print('stage timings '+ Metrics.stages(('collect', 'sweep', 'resolve', 'persist', 'report')))
 
-        # produce a readable report on active connections list
-        ReportWriter.write(conn_list, info_list, mr)
-        print('report produced with '+ str(len(conn_list)) +' connections and '+ str(len(info_list)) +' cached entries')
+            # quit if triggered
+            if g_quit_flag or args.sp:
+                break
 
-        # quit if triggered
-        if g_quit_flag or args.sp:
-            break
+            # length of sleep depending on CL flag
+            if args.m:
+                print('repeating the process in '+ str(args.m) +' minutes')
+                time.sleep(args.m*60)
+            else:
+                time.sleep(g_refresh_interval)
+    except KeyboardInterrupt:
+        print('\nstopping...')
+    finally:
+        pipeline.close()
+        if profiler != None:
+            profiler.disable()
+            profiler.dump_stats(args.pf)
+            print('profile written to '+ args.pf +' - python -m pstats '+ args.pf)
+        if server != None:
+            server.shutdown()
 
-        # length of sleep depending on CL flag
-        if args.m:
-            print('repeating the process in '+ str(args.m) +' minutes')
-            time.sleep(args.m*60)
-        else:
-            time.sleep(g_refresh_interval)
+# answer a query subcommand from the connection history
+def _query(history, args):
+    if not history.segments():
+        print('no connection history has been recorded, see -hs')
+        return
+    if args.query == 'first-seen':
+        found = history.first_seen(args.target)
+        if found == None:
+            print('no connection to '+ args.target +' has been recorded')
+            return
+        conn, info = found
+        ctype = 'UDP/IP' if conn['type'] == socket.SOCK_DGRAM else 'TCP/IP'
+        print(args.target +' first seen '+ datetime.fromtimestamp(conn['time']).strftime('%Y-%m-%d %H:%M:%S') +' '+ ctype +' '+ conn['local_ip'] +':'+ str(conn['local_port']) +' -> '+ conn['remote_ip'] +':'+ str(conn['remote_port']))
+        if info != None:
+            print(','.join((info['hostname'], info['city'], info['region'], info['country'], info['asn'])))
+        return
+    filters = {'country': args.country, 'asn': args.asn, 'host': args.host, 'remote_port': args.port, 'state': args.state}
+    if args.query == 'count':
+        counts = history.count(args.hours, args.by, **filters)
+        none = 'no connections were open'
+    else:
+        counts = history.count_new(args.hours, args.by, **filters)
+        none = 'no new connections were seen'
+    if not counts:
+        print(none +' over the last '+ f'{args.hours:g}' +' hours')
+        return
+    for key, n in counts.most_common():
+        print('%-48s %8d' % (key, n))
 
 # kb hook and entry point
 def _quit():
     global g_quit_flag
     g_quit_flag = True
     print('quit signal invoked...')
-keyboard.add_hotkey('ctrl+q', _quit)
+
+# the keyboard module is optional and its hook needs root and a terminal, the
+# process is terminated with CTRL+C or SIGTERM when it is not available
+def _register_hotkey():
+    if keyboard == None:
+        return False
+    try:
+        keyboard.add_hotkey('ctrl+q', _quit)
+        return True
+    except Exception:
+        return False
 if __name__ == "__main__":
     main()